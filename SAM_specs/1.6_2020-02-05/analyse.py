@@ -1,98 +1,212 @@
 import numpy as np
-from tqdm.auto import tqdm
 import os
 import sys
-import yaml
+import gzip
+import itertools
+import queue
+import shutil
+import threading
 
-# I know it looks horrible, but I had to do it to make it work
 two_levels_up = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(0, two_levels_up)
-from common_functions import toBinary
+from common_functions import textList, loadYaml
+from profiler import stage
+from coverage import newTrack, chunkGroups, addAt, sparseTrack, addSparse
+
+SPECS = loadYaml(os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs.yaml"))  # Shared with checks and summarize
+
+# Lookup tables used to parse whole chunks of CIGAR strings at once
+CIGAR_CODES = np.full(256, -1, dtype=np.int64)  # Byte of an operation -> index in SPECS['CIGAR_operations']
+for code, operation in enumerate(SPECS['CIGAR_operations']):
+    CIGAR_CODES[ord(operation)] = code
+CONSUMES_REFERENCE = np.array([op in "MDN=X" for op in SPECS['CIGAR_operations']])  # Operations walking on the reference
+COVERS_REFERENCE = np.array([op in "M=X" for op in SPECS['CIGAR_operations']])  # Operations adding to the depth
+MATCH = SPECS['CIGAR_operations'].index("M")
+POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+# Bits of the FLAG, tested on whole arrays of uint16 FLAG values
+FLAGS = {name: 1 << bit for bit, name in enumerate(SPECS['FLAG_bits'])}
+PROPER_PAIR = FLAGS['PROPER_PAIR']
+UNMAPPED = FLAGS['UNMAPPED']
+PAIRED = FLAGS['PAIRED']
+SEGMENT = FLAGS['FIRST_SEGMENT'] | FLAGS['LAST_SEGMENT']
+NOT_PRIMARY = FLAGS['SECONDARY'] | FLAGS['SUPPLEMENTARY']  # Other alignments of a read, they are not paired
+
+# Mapping categories of the reads, in the order of their codes
+CATEGORIES = ["mapped", "partially_mapped", "unmapped"]
+# Reads of a chromosome waiting for their mate, the oldest ones are given up beyond this number
+MATE_TABLE = 1 << 20
+
+#### FASTA files ####
+FASTA_BUFFER = 1 << 22  # Size of the write buffer of each FASTA file
+FASTA_QUEUE = 16  # Blocks waiting for the writer thread, the analysis waits when the writer is late
+FASTA_COMPRESSLEVEL = 1  # gzip level of the compressed FASTA files, the fastest one
+
+# Writer thread of the process: the blocks of FASTA records are written while the next reads are analysed
+writer = {"queue": None, "thread": None, "error": None}
+
+def fastaPath(path, category, compression=False):
+    return f"{path}/only_{category}.fasta" + (".gz" if compression else "")
+
+def toFasta(batch, indices):
+    """
+    Format some reads of a batch as FASTA records, all in one block of bytes.
+    """
+    names, sequences = textList(batch, "qname"), textList(batch, "seq")
+    mapq, pos = batch["mapq"].tolist(), batch["pos"].tolist()
+    return "".join([f">{names[n]} MAPQ:{mapq[n]} POS:{pos[n]}\n{sequences[n]}\n"
+                    for n in indices.tolist()]).encode("latin-1")
+
+def fastaWorker(blocks):
+    """
+    Write the blocks of the queue to their files until None is received, the files staying open in between.
+    """
+    files = {}
+    try:
+        while (item := blocks.get()) is not None:
+            file, data, compression = item
+            if file not in files:  # Appended since the file holds the previous chunks of the chromosome
+                files[file] = (gzip.open(file, "ab", compresslevel=FASTA_COMPRESSLEVEL) if compression
+                               else open(file, "ab", buffering=FASTA_BUFFER))
+            files[file].write(data)
+    except Exception as error:  # Raised in the analysing thread by closeFasta
+        writer["error"] = error
+        while blocks.get() is not None: pass  # Let the analysis go on until it closes the writer
+    finally:
+        for handle in files.values():
+            handle.close()
+
+def writeFasta(file, data, compression=False):
+    """
+    Append a block of FASTA records to a file, through the writer thread (started on the first block).
+    """
+    if writer["thread"] is None:
+        writer["queue"] = queue.Queue(maxsize=FASTA_QUEUE)
+        writer["thread"] = threading.Thread(target=fastaWorker, args=(writer["queue"],), daemon=True)
+        writer["thread"].start()
+    writer["queue"].put((file, data, compression))
 
-version = yaml.safe_load(open(f"{two_levels_up}/config.yaml", "r"))
-SPECS = yaml.safe_load(open(f"{two_levels_up}/SAM_specs/{version['version']}/specs.yaml", "r"))
+def closeFasta():
+    """
+    Wait for the writer thread to write every block and close the FASTA files.
+    """
+    if writer["thread"] is None: return
+    writer["queue"].put(None)
+    with stage("closeFasta"):  # Time left to write the FASTA files once the reads are analysed
+        writer["thread"].join()
+    error = writer["error"]
+    writer.update({"queue": None, "thread": None, "error": None})
+    if error is not None: raise error
+
+#### Pair the mates ####
+def pairMates(mates, names, segments, categories, max_waiting=MATE_TABLE):
+    """
+    Pair reads with their mate by QNAME and segment (FIRST_SEGMENT or LAST_SEGMENT bits of the FLAG), wherever
+    the mate is in the file: the reads wait in a table until their mate comes, so that the table only holds
+    the reads whose mate has not been seen yet, whether the file is sorted by name or by coordinate.
 
-#### Create a fasta header ####
-def toFasta(line):
-    return f">{line[0]} MAPQ:{line[0]} POS:{line[3]}\n{line[9]}\n"
+    Args:
+        mates (dict): The table of the reads waiting for their mate, QNAME -> (segment, category), updated in place.
+        names (list[str]): The QNAME of each read.
+        segments (list[int]): The segment bits of the FLAG of each read.
+        categories (list[int]): The mapping category of each read (index in CATEGORIES).
+        max_waiting (int): The maximal size of the table, the reads waiting for the longest time are given up
+                           (their mate is missing or filtered out) beyond it.
+
+    Returns:
+        numpy.ndarray: The categories of the two reads of each completed pair, one row per pair.
+    """
+    pairs = []
+    for name, segment, category in zip(names, segments, categories):
+        mate = mates.get(name)
+        if mate is not None and mate[0] != segment:  # The pair is complete, it leaves the table
+            del mates[name]
+            pairs.append((mate[1], category))
+        else:
+            mates[name] = (segment, category)
+
+    if len(mates) > max_waiting:  # The oldest reads are the first ones of the table
+        for name in list(itertools.islice(mates, len(mates) - max_waiting)):
+            del mates[name]
+
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+def pairCounts(pairs):
+    """
+    Count the pairs by mapping category (see pairMates).
+    """
+    p_mapped = int(np.count_nonzero((pairs[:, 0] == 0) & (pairs[:, 1] == 0)))  # Pairs where both reads are mapped
+    p_unmapped = int(np.count_nonzero((pairs[:, 0] == 2) & (pairs[:, 1] == 2)))  # Pairs where both reads are unmapped
+    return {"p_mapped": p_mapped, "p_unmapped": p_unmapped,
+            # Default case: the pairs where at least one read is partially mapped
+            "p_partially_mapped": len(pairs) - p_mapped - p_unmapped}
 
 #### Analyze the partially mapped or unmapped reads ####
-def readMapping(payload, path, verbose=True):
+def readMapping(batch, path, verbose=True, parsed=None, fasta=None, mates=None):
     """
-    Analyze the partially mapped or unmapped reads from the payload and write them to separate FASTA files.
+    Analyze the partially mapped or unmapped reads from the batch and write the requested categories to FASTA files.
 
     Args:
-        payload (list): A list of read information.
+        batch (dict): A batch of reads, see common_functions.toBatch. It needs SEQ when FASTA files are written.
         path (str): The directory path where the output FASTA files will be saved.
-        verbose (bool): If True, display a progress bar.
+        verbose (bool): If True, tell how many reads are sent to the FASTA files.
+        parsed (tuple): The CIGAR strings of the batch already parsed by parseBatchCigars, they are parsed if None.
+        fasta (dict): The FASTA export, "categories" the categories written and "compression" whether they are
+                      gzipped. No FASTA file is written if None.
+        mates (dict): The reads of the previous batches waiting for their mate (see pairMates), only the mates
+                      of the batch are paired if None.
 
     Returns:
         dict: A dictionary with counts of single and paired reads in different mapping categories.
+              A pair is counted in the batch completing it.
     """
-    # Determine file handlers dynamically
-    os.makedirs(path, exist_ok=True)
-    file_handlers = {
-        "partially_mapped": open(f"{path}/only_partially_mapped.fasta", "w"),
-        "unmapped": open(f"{path}/only_unmapped.fasta", "w"),
-        "mapped": open(f"{path}/only_mapped.fasta", "w"),
-    }
-
-    results = {"s_mapped": 0, "s_partially_mapped": 0, "s_unmapped": 0,
-               "p_mapped": 0, "p_partially_mapped": 0, "p_unmapped": 0}
-
-    iterator = list(zip(payload[::2], payload[1::2]))  # Pair reads together
-    if verbose:
-        iterator = tqdm(iterator,
-                        desc="Analyzing partially mapped and unmapped reads",
-                        total=len(iterator))
-
-    for lines in iterator:
-        lines = list(lines)
-        pair_mapping = []
-        for line in lines:
-            # Compute the binary representation of the flag with a length of 16 bits
-            flag = line[1]
-            cigar_mutations, _ = readCigar(line[5])
-
-            # Check if the read is partially mapped
-            if int(flag[-2]) == 1 and list(cigar_mutations.keys()) != ["M"]:
-                results["s_partially_mapped"] += 1  # Increment the count of partially mapped reads
-                # Mark the read as partially mapped
-                pair_mapping.append("p")
-                file_handlers["partially_mapped"].write(toFasta(line))  # Write to the partially mapped file
-
-            # Check if the read is mapped
-            elif int(flag[-2]) == 1:
-                results["s_mapped"] += 1  # Increment the count of mapped reads
-                pair_mapping.append("m")  # Mark the read as mapped
-                file_handlers["mapped"].write(toFasta(line))  # Write to the mapped file
-
-            # Check if the read is unmapped
-            elif int(flag[-3]) == 1:
-                results["s_unmapped"] += 1  # Increment the count of unmapped reads
-                pair_mapping.append("u")  # Mark the read as unmapped
-                file_handlers["unmapped"].write(toFasta(line))  # Write to the unmapped file
-
-            # Default case (flag 2 and 3 are not activated): mark the read as partially mapped
-            else:
-                results["s_partially_mapped"] += 1  # Increment the count of partially mapped reads
-                pair_mapping.append("p")  # Mark the read as partially mapped
-                file_handlers["partially_mapped"].write(toFasta(line))  # Write to the partially mapped file
-
-        # Check if all reads in the pair are mapped
-        if pair_mapping == ["m", "m"]:
-            results["p_mapped"] += 1  # Increment the count of pairs where both reads are mapped
-
-        # Check if all reads in the pair are unmapped
-        elif pair_mapping == ["u", "u"]:
-            results["p_unmapped"] += 1  # Increment the count of pairs where both reads are unmapped
-
-        # Default case: mark the pair as partially mapped
-        else:
-            results["p_partially_mapped"] += 1  # Increment the count of pairs where at least one read is partially mapped
+    if parsed is None: parsed = parseBatchCigars(batch)
+    flags = batch["flag"]
+    read_index, op_code, _ = parsed
+
+    # A read is fully mapped only if its CIGAR is made of alignment matches
+    n_operations = np.bincount(read_index, minlength=batch["size"])
+    n_mismatches = np.bincount(read_index, weights=op_code != MATCH, minlength=batch["size"])
+    only_match = (n_operations > 0) & (n_mismatches == 0)
+
+    # Properly paired reads are mapped, or partially mapped when their CIGAR is not only made of matches.
+    # The others are unmapped if their flag says so, else partially mapped
+    proper_pair = (flags & PROPER_PAIR) != 0
+    category = np.where(proper_pair, np.where(only_match, 0, 1), np.where((flags & UNMAPPED) != 0, 2, 1))
+
+    singles = np.bincount(category, minlength=len(CATEGORIES))
+    results = {"s_mapped": int(singles[0]), "s_partially_mapped": int(singles[1]), "s_unmapped": int(singles[2])}
+
+    # Pair the primary alignments of the paired reads with their mate
+    paired = np.flatnonzero(((flags & PAIRED) != 0) & ((flags & NOT_PRIMARY) == 0))
+    names = textList(batch, "qname")
+    results.update(pairCounts(pairMates({} if mates is None else mates, [names[n] for n in paired.tolist()],
+                                        (flags[paired] & SEGMENT).tolist(), category[paired].tolist())))
+
+    # One block per category, appended to its file in the background
+    for name in (fasta or {}).get("categories", []):
+        selected = np.flatnonzero(category == CATEGORIES.index(name))
+        if verbose:
+            from tqdm.auto import tqdm  # Only needed in verbose mode
+            tqdm.write(f"Writing {len(selected)} {name.replace('_', ' ')} reads")
+        if len(selected): writeFasta(fastaPath(path, name, fasta["compression"]), toFasta(batch, selected),
+                                     fasta["compression"])
 
     return results
 
+def flagBreakdown(flags):
+    """
+    Count the reads having each bit of their FLAG set.
+
+    Args:
+        flags (numpy.ndarray): The FLAG of each read as uint16.
+
+    Returns:
+        dict: The number of reads having each bit set, by name of the bit (see SPECS['FLAG_bits']).
+    """
+    bits = (flags[:, None] >> np.arange(len(SPECS['FLAG_bits']), dtype=np.uint16)) & 1
+    return {name: int(count) for name, count in zip(SPECS['FLAG_bits'], bits.sum(axis=0))}
+
 def readCigar(cigar):
     """
     Parse a CIGAR string and calculate the depth of the read.
@@ -106,31 +220,93 @@ def readCigar(cigar):
     if cigar == "*":  # If the read is unmapped
         return {}, np.array([])
 
+    _, op_code, length = parseCigars([cigar])
+
     dico = {}
-    num = 0
-    depth = []
-
-    # Parsing the CIGAR string
-    for char in cigar:
-        if char.isdigit():
-            # Build a number if the character is a digit
-            num = num * 10 + int(char)
-        else:
-            # Update the dictionary to count each operation
-            dico[char] = dico.get(char, 0) + num
-
-            # Handle different operations
-            if char in "M=":  # Alignment match
-                depth += [1] * num  # Add to depth
-            elif char in "DNX":  # Deletion, skipped region, or mismatch
-                depth += [0] * num  # Add zeros for bases missing in the query
-            elif char in "ISHP":  # Insertion, soft clipping, hard clipping, padding
-                pass
-            # Reset the counter for the next operator
-            num = 0
-
-    # Convert the depth list to a numpy array
-    return dico, np.array(depth)
+    for code, num in zip(op_code, length):
+        operation = SPECS['CIGAR_operations'][code]
+        dico[operation] = dico.get(operation, 0) + int(num)
+
+    # Bases of M, = and X add to the depth, bases of D and N are missing in the query
+    depth = np.repeat(COVERS_REFERENCE[op_code].astype(np.int64), length * CONSUMES_REFERENCE[op_code])
+    return dico, depth
+
+def parseCigars(cigars):
+    """
+    Parse a whole chunk of CIGAR strings at once.
+
+    Args:
+        cigars (list[str]): The CIGAR strings of the reads, "*" for the unmapped ones.
+
+    Returns:
+        tuple: Three numpy arrays with one value per operation: the index of its read, its code (index in
+               SPECS['CIGAR_operations']) and its length. The operations are sorted by read.
+    """
+    cigars = ["" if cigar == "*" else cigar for cigar in cigars]
+    offsets = np.zeros(len(cigars) + 1, dtype=np.int64)
+    np.cumsum([len(cigar) for cigar in cigars], out=offsets[1:])
+    buffer = np.frombuffer("".join(cigars).encode("ascii"), dtype=np.uint8)
+    return parseCigarBuffer(buffer, offsets)
+
+def parseCigarBuffer(buffer, offsets):
+    """
+    Parse CIGAR strings stored one after another in a byte buffer.
+
+    Args:
+        buffer (numpy.ndarray): The bytes (uint8) of the concatenated CIGAR strings.
+        offsets (numpy.ndarray): The start of each CIGAR in the buffer, followed by the end of the last one.
+
+    Returns:
+        tuple: The index of the read, the code and the length of every operation (see parseCigars).
+    """
+    op_position = np.flatnonzero(buffer > ord('9'))  # Operations are letters or '=', everything else is a digit
+    if len(op_position) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Each number starts right after the previous operation, even when the previous operation belongs to another read
+    number_start = np.empty_like(op_position)
+    number_start[0] = 0
+    number_start[1:] = op_position[:-1] + 1
+
+    # Weight every digit by its power of ten, the operations themselves weigh zero
+    digits = buffer[:op_position[-1] + 1].astype(np.int64) - ord('0')
+    digits[op_position] = 0
+    number_id = np.repeat(np.arange(len(op_position)), op_position - number_start + 1)
+    exponent = op_position[number_id] - 1 - np.arange(len(digits))
+    length = np.add.reduceat(digits * POWERS_OF_TEN[np.maximum(exponent, 0)], number_start)
+
+    read_index = np.searchsorted(offsets, op_position, side="right") - 1
+    return read_index, CIGAR_CODES[buffer[op_position]], length
+
+def parseBatchCigars(batch):
+    """
+    Get the CIGAR operations of a batch of reads, parsed from their text or, for the batches decoded from a BAM file,
+    unpacked from their binary encoding (length << 4 | code).
+
+    Args:
+        batch (dict): A batch of reads, see common_functions.toBatch.
+
+    Returns:
+        tuple: The index of the read, the code and the length of every operation (see parseCigars).
+    """
+    if "ops" not in batch:
+        return parseCigarBuffer(*batch["cigar"])
+    ops, offsets = batch["ops"]
+    return np.repeat(np.arange(batch["size"]), np.diff(offsets)), ops & 0xF, ops >> 4
+
+def referenceSpans(parsed, n_reads):
+    """
+    Compute the number of bases of the reference covered by each read.
+
+    Args:
+        parsed (tuple): The CIGAR strings parsed by parseCigars.
+        n_reads (int): The number of reads that were parsed.
+
+    Returns:
+        numpy.ndarray: The length of the reference covered by each read (0 for the unmapped ones).
+    """
+    read_index, op_code, length = parsed
+    return np.bincount(read_index, weights=length * CONSUMES_REFERENCE[op_code], minlength=n_reads).astype(np.int64)
 
 ### Analyze the CIGAR = regular expression that summarise each read alignment ###
 def percentMutation(dico) -> list:
@@ -157,61 +333,254 @@ def percentMutation(dico) -> list:
     return result
 
 
-def globalPercentCigar(payload: list[list], depth, mapq, verbose=False):
+def alignedBlocks(parsed, positions):
     """
-    Analyze the CIGAR strings from the payload and calculate the global percentage of each mutation type.
+    Locate on the reference the blocks of bases aligned by each read (M, = and X operations).
 
     Args:
-        payload (list[list]): A list of lists, where each inner list contains read information.
-        depth (numpy.ndarray): A numpy array representing the depth of the reads.
-        verbose (bool): If True, display a progress bar.
+        parsed (tuple): The CIGAR strings parsed by parseCigars.
+        positions (numpy.ndarray): The leftmost mapping position (POS) of each read.
 
     Returns:
-        tuple: A dictionary with the sum of each mutation type and the updated depth array.
+        tuple: The start, the end (excluded) and the index of the read of every aligned block.
     """
-    data = [[0] * len(SPECS['CIGAR_operations'])]  # Initialize the data list
-    # We have to put a first line of zeros to avoid an empty array
+    read_index, op_code, length = parsed
 
-    # Create an iterator with a progress bar if verbose is True
-    iterator = tqdm(enumerate(payload), desc="Analyzing CIGAR strings", total=len(payload)) if verbose else enumerate(payload)
+    # Offset of each operation from the start of its read on the reference
+    walked = length * CONSUMES_REFERENCE[op_code]
+    offset = np.cumsum(walked) - walked
+    first_operation = np.searchsorted(read_index, read_index)  # Index of the first operation of the read
+    offset -= offset[first_operation]
 
-    for n, line in iterator:
-        # Parse the CIGAR string and get the depth of the read
-        if line[5] == "*":  # Skip the read if it is unmapped
-            continue
+    aligned = COVERS_REFERENCE[op_code] & (length > 0)
+    start = positions[read_index[aligned]] + offset[aligned]
+    return start, start + length[aligned], read_index[aligned]
 
-        dico, line_depth = readCigar(line[5])
-
-        # Calculate the percentage of each mutation type
-        percent_mut = percentMutation(dico)
-
-        line_mapq = int(line[4])
-        pos = int(line[3])
-        flag = line[1]
-
-        if flag[-5] == "1":  # Reverse the depth array if the read is reverse
-            line_depth = line_depth[::-1]  # Reverse the depth array
-            start = pos - len(line_depth)
-            end = pos
-        else:
-            start = pos
-            end = pos + len(line_depth)
+def globalPercentCigar(batch: dict, coverage, mapq, parsed=None):
+    """
+    Analyze the CIGAR strings from the batch and calculate the global percentage of each mutation type.
 
-        data.append(percent_mut)
-        depth[start:end] += line_depth
-        mapq[start:end] = line_mapq  # Here is another limitation of the current implementation
-        # It should do the mean of the MAPQ scores for each position, but it's not implemented yet
+    Args:
+        batch (dict): A batch of reads, see common_functions.toBatch.
+        coverage (dict): The difference track of the depth (see coverage.newTrack): +1 where an aligned block starts
+                         and -1 where it ends. Its cumulative sum is the depth (see finalizeAccumulator).
+        mapq (dict): The difference tracks of the MAPQ: "sum" of the MAPQ of the reads covering each position
+                     and, if not None, "histogram" counting them by MAPQ class (one column per class).
+        parsed (tuple): The CIGAR strings of the batch already parsed by parseBatchCigars, they are parsed if None.
 
-    # Convert the data list to a numpy array
-    data = np.array(data)
+    Returns:
+        tuple: A dictionary with the sum of each mutation type and the updated coverage and MAPQ tracks.
+               The chunks of the tracks are allocated as the reads reach them.
+    """
+    if parsed is None: parsed = parseBatchCigars(batch)
+    read_index, op_code, length = parsed
+
+    # Percentage of each mutation type inside its read, summed over the reads
+    read_length = np.bincount(read_index, weights=length, minlength=batch["size"])
+    percent = length * 100 / np.maximum(read_length[read_index], 1)
+    sums = np.bincount(op_code, weights=percent, minlength=len(SPECS['CIGAR_operations']))
+
+    # Only the edges of the aligned blocks are recorded, POS is the leftmost position whatever the strand
+    block_start, block_end, block_read = alignedBlocks(parsed, batch["pos"])
+    starts, ends = chunkGroups(block_start, coverage["chunk"]), chunkGroups(block_end, coverage["chunk"])
+    addAt(coverage, starts, 1)
+    addAt(coverage, ends, -1)
+
+    # The MAPQ of the reads are accumulated the same way, the number of reads covering a position being the depth
+    block_mapq = batch["mapq"][block_read].astype(np.int64)
+    addAt(mapq["sum"], starts, block_mapq)
+    addAt(mapq["sum"], ends, -block_mapq)
+    if mapq["histogram"] is not None:
+        mapq_class = block_mapq * mapq["histogram"]["columns"][0] // 256
+        addAt(mapq["histogram"], starts, 1, mapq_class)
+        addAt(mapq["histogram"], ends, -1, mapq_class)
 
     # Create a dictionary to store the sum of each mutation type
     columns_dict = {}
     for n, mut in enumerate(SPECS['CIGAR_operations']):
-        columns_dict[mut] = data[:, n].sum()
-        if columns_dict[mut] is np.nan: columns_dict[mut] = 0.
+        columns_dict[mut] = sums[n]
+
+    return columns_dict, coverage, mapq
+
+
+#### Streaming accumulation of the reads of a chromosome ####
+def emptyCounts():
+    """
+    The mapping counts and the CIGAR and FLAG totals of a chromosome without any read.
+
+    Returns:
+        dict: The "results", "cigar" and "flags" of an accumulator (see newAccumulator), all zero.
+    """
+    return {"results": {"s_mapped": 0, "s_partially_mapped": 0, "s_unmapped": 0,
+                        "p_mapped": 0, "p_partially_mapped": 0, "p_unmapped": 0},
+            "cigar": {mut: 0 for mut in SPECS['CIGAR_operations']},
+            "flags": {name: 0 for name in SPECS['FLAG_bits']}}
+
+
+def newAccumulator(path, mapq_classes=0, fasta=None, length=0):
+    """
+    Create an empty accumulator holding the running totals of a chromosome.
+
+    Args:
+        path (str): The directory path where the output FASTA files of the chromosome will be saved, it is only
+                    created when FASTA files are exported.
+        mapq_classes (int): The number of MAPQ classes counted at each position to compute the median MAPQ,
+                            0 to only keep the sum of the MAPQ (mean MAPQ).
+        fasta (dict): The FASTA export (see readMapping), None to write no FASTA file.
+        length (int): The length of the reference of the chromosome (@SQ LN), 0 if unknown. The chunks of the tracks
+                      reached by the reads are then allocated once at their full size, instead of growing.
 
-    return columns_dict, depth, mapq
+    Returns:
+        dict: The mapping counts, the CIGAR and FLAG totals and the coverage and MAPQ tracks of the chromosome.
+    """
+    # Truncate the FASTA files since readMapping appends to them chunk after chunk
+    categories = (fasta or {}).get("categories", [])
+    if categories: os.makedirs(path, exist_ok=True)  # The directory only holds the FASTA files
+    for name in categories:
+        open(fastaPath(path, name, fasta["compression"]), "w").close()
+
+    positions = length + 2 if length > 0 else 0  # The aligned blocks end one base after the last position at most
+    return {"path": path,
+            "fasta": fasta,
+            "mates": {},  # Reads waiting for their mate, see pairMates
+            **emptyCounts(),
+            "coverage": newTrack(positions, np.int32),  # Difference track of the depth
+            "mapq": {"sum": newTrack(positions, np.int64),
+                     "histogram": newTrack(positions, np.int32, (mapq_classes,)) if mapq_classes > 0 else None}}
+
+
+def accumulate(accumulator, batch, verbose=False):
+    """
+    Analyze a chunk of reads and add it to the running totals of its chromosome.
+
+    Args:
+        accumulator (dict): The accumulator created by newAccumulator.
+        batch (dict): A chunk of reads of the chromosome (see common_functions.toBatch), the mates of its reads
+                      may be in other chunks.
+        verbose (bool): If True, display a progress bar.
+    """
+    with stage("parseBatchCigars", records=batch["size"]):
+        parsed = parseBatchCigars(batch)  # Parsed once for both analyses
+
+    with stage("readMapping", records=batch["size"]):
+        results = readMapping(batch, accumulator["path"], verbose=verbose, parsed=parsed,
+                              fasta=accumulator.get("fasta"), mates=accumulator["mates"])
+    for category, count in results.items():
+        accumulator["results"][category] += count
+    with stage("flagBreakdown", records=batch["size"]):
+        flags = flagBreakdown(batch["flag"])
+    for name, count in flags.items():
+        accumulator["flags"][name] += count
+
+    with stage("globalPercentCigar", records=batch["size"]):
+        cigar, accumulator["coverage"], accumulator["mapq"] = globalPercentCigar(batch, accumulator["coverage"],
+                                                                                 accumulator["mapq"], parsed=parsed)
+    for mutation, total_value in cigar.items():
+        accumulator["cigar"][mutation] += total_value
+
+
+def compactAccumulator(accumulator):
+    """
+    Shrink an accumulator before sending it to another process: the difference tracks being mostly made of zeros,
+    only their non-zero values are kept.
+
+    Args:
+        accumulator (dict): The accumulator created by newAccumulator.
+
+    Returns:
+        dict: The same accumulator where the tracks are replaced by (shape, indices, values) tuples (see
+              coverage.sparseTrack).
+    """
+    compact = dict(accumulator)
+    compact["coverage"] = sparseTrack(accumulator["coverage"])
+    compact["mapq"] = {track: None if values is None else sparseTrack(values)
+                       for track, values in accumulator["mapq"].items()}
+    return compact
+
+
+def mergeAccumulators(accumulator, partial):
+    """
+    Add a partial accumulator (see compactAccumulator) of the same chromosome to an accumulator.
+    Merging is associative, so the partial accumulators can come from any split of the reads.
+
+    Args:
+        accumulator (dict): The accumulator created by newAccumulator, it is updated in place.
+        partial (dict): The compacted accumulator to add, its FASTA files are appended to the ones of the accumulator
+                        (gzip members can be concatenated as well). Its reads waiting for their mate are paired
+                        with the ones of the accumulator, so the partial accumulators have to be added in the order
+                        of the file.
+    """
+    for category, count in partial["results"].items():
+        accumulator["results"][category] += count
+    for mutation, total_value in partial["cigar"].items():
+        accumulator["cigar"][mutation] += total_value
+    for name, count in partial["flags"].items():
+        accumulator["flags"][name] += count
+    waiting = list(partial["mates"].items())
+    pairs = pairMates(accumulator["mates"], [name for name, _ in waiting], [segment for _, (segment, _) in waiting],
+                      [category for _, (_, category) in waiting])
+    for category, count in pairCounts(pairs).items():
+        accumulator["results"][category] += count
+
+    addSparse(accumulator["coverage"], *partial["coverage"])
+    for track, sparse in partial["mapq"].items():
+        if sparse is not None: addSparse(accumulator["mapq"][track], *sparse)
+
+    fasta = accumulator.get("fasta") or {}
+    for name in fasta.get("categories", []):
+        source_file = fastaPath(partial["path"], name, fasta["compression"])
+        if not os.path.exists(source_file): continue
+        with open(fastaPath(accumulator["path"], name, fasta["compression"]), "ab") as destination, \
+                open(source_file, "rb") as source:
+            shutil.copyfileobj(source, destination, FASTA_BUFFER)
+
+
+def finalizeAccumulator(accumulator):
+    """
+    Compute the depth and MAPQ tracks of a chromosome once all its reads have been accumulated, chunk after chunk:
+    only the chunks where a read maps are allocated.
+
+    Args:
+        accumulator (dict): The accumulator created by newAccumulator.
+
+    Returns:
+        tuple: The depth and the MAPQ tracks (see coverage.newTrack) of the chromosome. The MAPQ is the median of
+               the reads covering the position when MAPQ classes are counted, else their mean. It is 0 where no read
+               maps.
+    """
+    coverage, (mapq_sum, histogram) = accumulator["coverage"], (accumulator["mapq"]["sum"],
+                                                                accumulator["mapq"]["histogram"])
+    chunk, length = coverage["chunk"], coverage["length"]
+    depth, mapq = newTrack(length, np.int32, chunk=chunk), newTrack(length, np.float64, chunk=chunk)
+
+    def block(track, index):  # The differences of a chunk, over its whole size
+        values = np.zeros((min(chunk, length - index * chunk), *track["columns"]), dtype=track["dtype"])
+        stored = track["chunks"].get(index)
+        if stored is not None: values[:len(stored)] = stored[:len(values)]
+        return values
+
+    # The cumulative sums go on from chunk to chunk, a chunk without any read edge only holding the running depth
+    running = {"depth": 0, "sum": 0, "histogram": 0}
+    for index in range(-(-length // chunk)):
+        if index not in coverage["chunks"] and running["depth"] == 0: continue  # No read covers the chunk
+
+        chunk_depth = np.cumsum(block(coverage, index), dtype=np.int32) + running["depth"]
+        running["depth"] = int(chunk_depth[-1])
+        if histogram is None:
+            chunk_sum = np.cumsum(block(mapq_sum, index)) + running["sum"]
+            running["sum"] = int(chunk_sum[-1])
+            chunk_mapq = chunk_sum / np.maximum(chunk_depth, 1)
+        else:
+            # The median class is the first one holding half of the reads, its MAPQ is the middle of the class
+            classes = np.cumsum(block(histogram, index), axis=0) + running["histogram"]
+            running["histogram"] = classes[-1]
+            below = np.cumsum(classes, axis=1)
+            median_class = np.argmax(2 * below >= np.maximum(chunk_depth, 1)[:, None], axis=1)
+            width = 256 / histogram["columns"][0]
+            chunk_mapq = np.where(chunk_depth > 0, np.floor(median_class * width + (width - 1) / 2), 0)
+        if chunk_depth.any(): depth["chunks"][index], mapq["chunks"][index] = chunk_depth, chunk_mapq
+
+    return depth, mapq
 
 
 def main():
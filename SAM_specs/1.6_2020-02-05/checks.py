@@ -1,15 +1,28 @@
 import re
 import sys
-import yaml
 import os
+import numpy as np
 
-# I know it looks horrible, but I had to do it to make it work
 two_levels_up = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(0, two_levels_up)
-from common_functions import toBinary
+from common_functions import loadYaml
 
-version = yaml.safe_load(open(f"{two_levels_up}/config.yaml", "r"))
-SPECS = yaml.safe_load(open(f"{two_levels_up}/SAM_specs/{version['version']}/specs.yaml", "r"))
+SPECS = loadYaml(os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs.yaml"))
+
+# The validator is built once from the specs: integer fields are checked against their bounds,
+# the other ones against their compiled regex
+INTEGER_RANGES = {field: tuple(bounds) for field, bounds in SPECS['integer_ranges'].items()}
+PATTERNS = {field: re.compile(SPECS['regex_queries'][field])
+            for field in SPECS['mandatory_fields'] if field not in INTEGER_RANGES}
+INTEGER_PATTERN = re.compile("-?[0-9]+")
+
+# One pattern for the whole line (the mandatory fields joined by tabs) so that valid lines are checked at once
+LINE_PATTERN = re.compile("\t".join(f"(?:{SPECS['regex_queries'][field]})" if field in PATTERNS else INTEGER_PATTERN.pattern
+                                    for field in SPECS['mandatory_fields']))
+INTEGER_COLUMNS = [(n, *INTEGER_RANGES[field]) for n, field in enumerate(SPECS['mandatory_fields'])
+                   if field in INTEGER_RANGES]
+# The same pattern for lines that are still bytes, in a file mapped in memory
+LINE_BYTES_PATTERN = re.compile(LINE_PATTERN.pattern.encode())
 
 def display_error_context(valist:list, problematic_param:str) -> str:
     """
@@ -20,6 +33,7 @@ def display_error_context(valist:list, problematic_param:str) -> str:
     """
     # Define the parameter list
     param_list = SPECS["mandatory_fields"]
+    problematic_param = problematic_param.upper()  # The fields are named in upper case in the specs
 
     # Check if the problematic parameter is in the list
     if problematic_param not in param_list:
@@ -49,48 +63,78 @@ def display_error_context(valist:list, problematic_param:str) -> str:
 # All the check functions return a boolean value
 # Based on SAMv1 specifications
 
+def integer(tested: str, field: str) -> bool:
+    if INTEGER_PATTERN.fullmatch(tested) is None:
+        return False
+    low, high = INTEGER_RANGES[field]
+    return low <= int(tested) <= high
+
 def qname(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['QNAME'], tested) is not None
+    return PATTERNS['QNAME'].fullmatch(tested) is not None
 
 def flag(tested: str) -> bool:
-    if not tested.replace('-', '').isdigit():
-        return False
-    return re.match(SPECS['regex_queries']['FLAG'], toBinary(tested, 16)) is not None
+    return integer(tested, 'FLAG')
 
 def rname(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['RNAME'], tested) is not None
+    return PATTERNS['RNAME'].fullmatch(tested) is not None
 
 def pos(tested: str) -> bool:
-    if not tested.replace('-', '').isdigit():
-        return False
-    return re.match(SPECS['regex_queries']['POS'], toBinary(tested, 31)) is not None
+    return integer(tested, 'POS')
 
 def mapq(tested: str) -> bool:
-    if not tested.replace('-', '').isdigit():
-        return False
-    return re.match(SPECS['regex_queries']['MAPQ'], toBinary(tested, 8)) is not None
+    return integer(tested, 'MAPQ')
 
 def cigar(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['CIGAR'], tested) is not None
+    return PATTERNS['CIGAR'].fullmatch(tested) is not None
 
 def rnext(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['RNEXT'], tested) is not None
+    return PATTERNS['RNEXT'].fullmatch(tested) is not None
 
 def pnext(tested: str) -> bool:
-    if not tested.isdigit():
-        return False
-    return re.match(SPECS['regex_queries']['PNEXT'], toBinary(tested, 31)) is not None
+    return integer(tested, 'PNEXT')
 
 def tlen(tested: str) -> bool:
-    if not tested.replace('-', '').isdigit():
-        return False
-    return re.match(SPECS['regex_queries']['TLEN'], toBinary(tested, 31)) is not None
+    return integer(tested, 'TLEN')
 
 def seq(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['SEQ'], tested) is not None
+    return PATTERNS['SEQ'].fullmatch(tested) is not None
 
 def qual(tested: str) -> bool:
-    return re.match(SPECS['regex_queries']['QUAL'], tested) is not None
+    return PATTERNS['QUAL'].fullmatch(tested) is not None
+
+def valid_line(line: list) -> bool:
+    """
+    Fast path of the checks: a single regex over the mandatory fields, then the bounds of the integer fields
+    :param line: The payload to check
+    :return: True if every field is valid
+    """
+    if LINE_PATTERN.fullmatch("\t".join(line[:len(SPECS['mandatory_fields'])])) is None:
+        return False
+    for n, low, high in INTEGER_COLUMNS:
+        if not low <= int(line[n]) <= high:
+            return False
+    return True
+
+def check_block(buffer, starts, ends, integers: dict, label) -> None:
+    """
+    Check a block of lines without decoding them, the whole line being reported by check_line if one is invalid
+    :param buffer: The bytes holding the lines (e.g. a file mapped in memory)
+    :param starts: The start of each line in the buffer
+    :param ends: The end of the mandatory fields of each line in the buffer
+    :param integers: The value of each integer field of the lines, by field name
+    :param label: A function giving the label (line number) of the n-th line of the block
+    :return:
+    """
+    fullmatch = LINE_BYTES_PATTERN.fullmatch
+    valid = np.fromiter((fullmatch(buffer, start, end) is not None for start, end in zip(starts.tolist(), ends.tolist())),
+                        dtype=bool, count=len(starts))
+    for field, (low, high) in INTEGER_RANGES.items():
+        valid &= (integers[field] >= low) & (integers[field] <= high)
+
+    if not valid.all():
+        n = int(np.argmin(valid))
+        line = bytes(buffer[starts[n]:ends[n]]).decode(errors="replace").split('\t')
+        check_line(line + [label(n)])
 
 def check_line(line:list, trusted=False) -> None:
     """
@@ -113,8 +157,9 @@ def check_line(line:list, trusted=False) -> None:
     :param trusted: If the payload is trusted or not
     :return:
     """
-    if trusted: return
+    if trusted or valid_line(line): return
 
+    # The line is invalid, find the first faulty field to report it
     # col 1 : QNAME
     if not qname(line[0]):
         print(f'Error with QNAME line {line[-1]} :'
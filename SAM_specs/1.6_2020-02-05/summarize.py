@@ -1,24 +1,132 @@
-import subprocess, os, shutil, string
-import yaml
+import subprocess, os, shutil, string, re, sys, hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 two_levels_up = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-config = yaml.safe_load(open(f"{two_levels_up}/config.yaml", "r"))
+sys.path.insert(0, two_levels_up)
+from cache import cacheDirectory, evict
+from common_functions import loadConfig, loadYaml
+from profiler import stage
 
-def compile_latex(path, file_name, latex_content):
+SPECS = loadYaml(os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs.yaml"))
+
+# Pages already rendered, by the hash of their .tex file and of their images, and the formats of their preamble,
+# in this directory of the cache
+PAGES_CACHE = "pages"
+
+def write_latex(path, file_name, latex_content):
     with open(os.path.join(path, f"{file_name}.tex"), "w") as file:
         file.write(latex_content)
 
-    # Compile the .tex file to a .pdf file
+def page_key(tex_file):
+    """
+    Hash of a page: its .tex file and the images it includes (relative to the working directory, as for latexmk).
+    """
+    with open(tex_file, "rb") as file:
+        content = file.read()
+    digest = hashlib.blake2b(content, digest_size=20)
+    for image in re.findall(rb"\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}", content):
+        image = image.decode()
+        if not os.path.exists(image): image += ".png"
+        if os.path.exists(image):
+            with open(image, "rb") as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+def build_format(tex_file, pages_cache):
+    """
+    Dump the preamble of a page in a format (mylatexformat) so that its packages are loaded once for all the pages
+    sharing it. The format is kept with the cached pages.
+
+    Returns:
+        str: The path of the format without its .fmt extension, None if it cannot be built.
+    """
+    with open(tex_file, "r") as file:
+        preamble = file.read().split("\\begin{document}")[0]
+    name = f"preamble_{hashlib.blake2b(preamble.encode(), digest_size=8).hexdigest()}"
+    fmt = os.path.join(pages_cache, name)
+    if os.path.exists(f"{fmt}.fmt"): return fmt
+
+    try:
+        os.makedirs(pages_cache, exist_ok=True)
+        with open(f"{fmt}.tex", "w") as file:
+            file.write(preamble + "\\begin{document}\n\\end{document}\n")
+        with open(os.devnull, 'w') as devnull:
+            subprocess.run(["pdflatex", "-ini", f"-jobname={name}", f"-output-directory={pages_cache}", "&pdflatex",
+                            "mylatexformat.ltx", f"{fmt}.tex"], stdout=devnull, stderr=devnull)
+    except OSError:  # No pdflatex or a read-only cache, latexmk is used as it is
+        pass
+    return fmt if os.path.exists(f"{fmt}.fmt") else None
+
+def compile_latex(path, file_name, fmt=None):
+    """
+    Compile the .tex file of a page to a .pdf file, in its own temporary directory so that pages can be compiled
+    at the same time. The precompiled preamble is used if given, the page is compiled again without it on failure.
+    """
+    output = os.path.join(path, "temp", file_name)
 
     # This line is just for debugging, ignore
-    # subprocess.run(["latexmk", f"--output-directory={path}/temp", "-pdf", os.path.join(path, f"{file_name}.tex")])
+    # subprocess.run(["latexmk", f"--output-directory={output}", "-pdf", os.path.join(path, f"{file_name}.tex")])
 
-    with open(os.devnull, 'w') as devnull:
-        subprocess.run(["latexmk", "-silent", f"--output-directory={path}/temp", "-pdf", os.path.join(path, f"{file_name}.tex")],
-                       stdout=devnull, stderr=devnull)
+    for engine in ([f"-pdflatex=pdflatex -fmt={fmt} %O %S"] if fmt else []) + [[]]:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.run(["latexmk", "-silent", *([engine] if engine else []), f"--output-directory={output}", "-pdf",
+                            os.path.join(path, f"{file_name}.tex")], stdout=devnull, stderr=devnull)
+        if os.path.exists(os.path.join(output, f"{file_name}.pdf")): break
 
     # Move the .pdf file to the main directory
-    shutil.move(os.path.join(path, 'temp', f"{file_name}.pdf"), os.path.join(path, f"{file_name}.pdf"))
+    shutil.move(os.path.join(output, f"{file_name}.pdf"), os.path.join(path, f"{file_name}.pdf"))
+
+def render_pages(path, names, workers=1):
+    """
+    Render the pages of the report, several at once. Pages identical to an already rendered one (same .tex and
+    same images) are copied from the cache of the pages instead of being compiled, and identical pages of the same
+    report are compiled once.
+
+    :param path: The results directory holding the .tex files of the pages
+    :param names: The names of the pages
+    :param workers: The number of pages compiled at the same time
+    """
+    config = loadConfig()
+    use_cache = config['cache size'] > 0
+    pages_cache = os.path.join(cacheDirectory(config), PAGES_CACHE)
+    keys = {name: page_key(os.path.join(path, f"{name}.tex")) for name in names}
+    todo = {}  # One page to compile for each key
+    for name, key in keys.items():
+        if not (use_cache and os.path.exists(os.path.join(pages_cache, f"{key}.pdf"))): todo.setdefault(key, name)
+
+    if todo:
+        fmt = build_format(os.path.join(path, f"{next(iter(todo.values()))}.tex"), pages_cache)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:  # latexmk runs in its own process
+            list(pool.map(lambda name: compile_latex(path, name, fmt), todo.values()))
+
+    for name, key in keys.items():
+        cached = os.path.join(pages_cache, f"{key}.pdf")
+        if todo.get(key) == name:
+            if use_cache: store_page(os.path.join(path, f"{name}.pdf"), cached)
+        elif use_cache:
+            shutil.copyfile(cached, os.path.join(path, f"{name}.pdf"))
+            try:
+                os.utime(cached)  # Most recently used
+            except OSError:  # Cache shared read-only
+                pass
+        else:  # Same page as another one of the report
+            shutil.copyfile(os.path.join(path, f"{todo[key]}.pdf"), os.path.join(path, f"{name}.pdf"))
+    if use_cache and os.path.isdir(pages_cache):
+        try:
+            evict(pages_cache, config['cache size'] << 20, extension=".pdf")
+        except OSError:
+            pass
+
+def store_page(page, cached):
+    """
+    Copy a compiled page to the cache of the pages, the page is only kept in the report when the cache cannot be
+    written (read-only or full directory).
+    """
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        shutil.copyfile(page, cached)
+    except OSError:
+        if os.path.exists(cached): os.remove(cached)  # No truncated page
 
 def format_metric(value, nb_reads):
     """
@@ -31,11 +139,40 @@ def format_metric(value, nb_reads):
         str: The formatted percentage string.
     """
     nb_reads = max(nb_reads, 1)  # Avoid division by zero
-    mid = f"{(value / nb_reads) * 100:.{config['significant figures']}f}"
+    mid = f"{(value / nb_reads) * 100:.{loadConfig()['significant figures']}f}"
     return mid + "\\%"
 
 
-def make_chromosome(file_name, results, path):
+def metrics(results):
+    """
+    Get the numbers of a page (chromosome or genome) as plain values, for the machine-readable outputs.
+
+    Args:
+        results (dict): The results of the chromosome, or their sum for the genome.
+
+    Returns:
+        dict: The percentage of each CIGAR operation, the single and paired mapping counts, the low quality counts,
+              the number of reads having each FLAG bit and the mapping ratio.
+    """
+    nb_reads = max(sum([results[key] for key in SPECS['CIGAR_operations']]), 1)  # Avoid division by zero
+    values = {f"cigar_{key}": (results[key] / nb_reads) * 100 for key in SPECS['CIGAR_operations']}
+
+    for key in ["s_mapped", "s_partially_mapped", "s_unmapped", "p_mapped", "p_partially_mapped", "p_unmapped"]:
+        values[key] = int(results[key])
+    values["s_total"] = int(results["total"])
+    values["p_total"] = int(results["total"]) // 2
+    values["s_low_qual"] = values["s_total"] - values["s_mapped"] - values["s_partially_mapped"] - values["s_unmapped"]
+    values["p_low_qual"] = values["p_total"] - values["p_mapped"] - values["p_partially_mapped"] - values["p_unmapped"]
+
+    for name in SPECS['FLAG_bits']:
+        values[name.lower()] = int(results[name])
+
+    analysed = values["s_mapped"] + values["s_partially_mapped"] + values["s_unmapped"]
+    values["mapping_ratio"] = (values["s_mapped"] + 0.5 * values["s_partially_mapped"]) / max(analysed, 1)
+    return values
+
+
+def make_chromosome(file_name, results, path, image="temp/chromosome.png"):
     latex_content = open(f"{os.path.dirname(os.path.abspath(__file__))}/chromosome.tex", "r").read()
     latex_content = latex_content.replace("\r\n", "\n")
 
@@ -52,6 +189,7 @@ def make_chromosome(file_name, results, path):
         "X": format_metric(results["X"], nb_reads),
         "E": format_metric(results["="], nb_reads),
         "read_name": file_name,
+        "image": image,
         "s_partially_mapped": results["s_partially_mapped"],
         "p_partially_mapped": results["p_partially_mapped"],
         "s_unmapped": results["s_unmapped"],
@@ -63,11 +201,15 @@ def make_chromosome(file_name, results, path):
         "qual": results["qual"],
         "p_low_qual": results["total"]//2 - results["p_mapped"] - results["p_partially_mapped"] - results["p_unmapped"],
         "s_low_qual": results["total"] - results["s_mapped"] - results["s_partially_mapped"] - results["s_unmapped"],
+        "duplicate": results["DUPLICATE"],
+        "secondary": results["SECONDARY"],
+        "supplementary": results["SUPPLEMENTARY"],
+        "qc_fail": results["QC_FAIL"],
     }
 
     latex_content = latex_content.format(**data_dict)
 
-    compile_latex(path, file_name, latex_content)
+    write_latex(path, file_name, latex_content)
 
 
 def make_genome(file_name, results, path):
@@ -93,22 +235,31 @@ def make_genome(file_name, results, path):
 
     latex_content = latex_content.format(**data_dict)
 
-    compile_latex(path, file_name, latex_content)
+    write_latex(path, file_name, latex_content)
+
 
+def summarize(file_name, results, path, verbose=False, genome=False, image="temp/chromosome.png", workers=1):
+    """
+    Write the page of a chromosome. The page of the genome comes last: every page is then rendered
+    and the pages are fused in the report.
+    """
+    if not genome:
+        make_chromosome(file_name, results, path, image)
+        return
 
-def summarize(file_name, results, path, verbose=False, genome=False):
-    if genome:
-        make_genome('genome', results, path)
-        fuze_pdf(file_name, results['chromosomes'], path)
+    names = list(results['chromosomes'])
+    make_genome('genome', results, path)
+    with stage("render_pages", records=len(names) + 1):
+        render_pages(path, ['genome', *names], workers)
+    with stage("fuze_pdf"):
+        fuze_pdf(file_name, names, path)
 
-        if verbose:
-            print(f'\nThe results are available in the file {path}/{file_name}.pdf')
-        file_name = 'genome'
-    else:
-        make_chromosome(file_name, results, path)
+    if verbose:
+        print(f'\nThe results are available in the file {path}/{file_name}.pdf')
 
-    shutil.rmtree(f"{path}/temp")
-    os.remove(f"{path}/{file_name}.tex")
+    shutil.rmtree(f"{path}/temp", ignore_errors=True)
+    for name in ['genome', *names]:
+        os.remove(f"{path}/{name}.tex")
 
 def fuze_pdf(file_name, names, path):
     names = list(names)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3.13
+#-*- coding : utf-8 -*-
+
+import os, sys, getopt, json, tempfile, time, resource, subprocess
+import numpy as np
+
+from common_functions import loadConfig
+from readers import scanSam
+from coverage import newTrack, denseTrack, coveredSpan
+from main import loadModules, checkFormat, chromosomeResults
+
+USAGE = """Usage: benchmark.py [options]
+  -i, --input <file.sam>      Benchmark an existing SAM file instead of a synthetic one
+  -r, --reads <N>             Number of reads of the synthetic file (100000 by default)
+  -l, --read-length <N>       Length of the synthetic reads (100 by default)
+  -c, --cigar <N>             Number of insertions and deletions in each synthetic CIGAR (1 by default)
+  -y, --layout <layout>       name (mates next to each other, default), coordinate (sorted by position) or single
+  -n, --chromosomes <N>       Number of chromosomes of the synthetic file (3 by default)
+  -s, --seed <N>              Seed of the synthetic file
+  -k, --keep <file.sam>       Keep the synthetic file at this path
+  -p, --threads <N>           Number of processes of the checkFormat stage
+  -o, --output <file.json>    Write the measures in a JSON file
+  -b, --baseline <file.json>  Compare with the measures of --output, exit with 1 on a regression
+  -t, --tolerance <ratio>     Slowdown of a stage accepted before it is a regression (0.1 by default)
+  -v, --verbose               Tell which stage runs"""
+
+# Stages timed by the benchmark, in their order in the pipeline
+STAGES = ["generate", "checkFormat", "check_line", "readCigar", "readMapping", "globalPercentCigar",
+          "plot_depth_mapq", "summarize"]
+# Reads written at once by the generator
+GENERATOR_BLOCK = 1 << 14
+# FLAG bits used by the generator
+PAIRED, PROPER_PAIR, UNMAPPED, MATE_UNMAPPED, REVERSE, MATE_REVERSE, FIRST, LAST = (1 << bit for bit in range(8))
+
+#### Synthetic SAM files ####
+def syntheticCigars(rng, n, read_length, operations):
+    """
+    Draw CIGAR strings of read_length query bases, with the given number of insertions and deletions
+    between alignment matches and a soft clip at the start of half of the reads.
+    """
+    if operations == 0: return [f"{read_length}M"] * n
+
+    kinds = rng.choice(np.array(["I", "D"]), size=(n, operations))
+    lengths = rng.integers(1, 4, size=(n, operations))
+    clipped = np.where(rng.random(n) < 0.5, rng.integers(1, 6, size=n), 0)
+    matched = read_length - clipped - np.where(kinds == "I", lengths, 0).sum(axis=1)  # The rest of the query
+    # The short reads leave too few bases to the matches: no soft clip and insertions of one base
+    short = matched < operations + 1
+    clipped[short], lengths[short] = 0, 1
+    matched[short] = read_length - (kinds[short] == "I").sum(axis=1)
+    # Split the matches in operations + 1 blocks of at least one base, at distinct cuts between 1 and matched - 1
+    cuts = np.sort(rng.integers(0, (matched - operations)[:, None], size=(n, operations)), axis=1) + \
+        np.arange(1, operations + 1)
+    blocks = np.diff(np.column_stack((np.zeros(n, dtype=np.int64), cuts, matched)), axis=1)
+    cigars = []
+    for k in range(n):
+        parts = [f"{clipped[k]}S"] if clipped[k] else []
+        for m in range(operations):
+            parts.append(f"{blocks[k, m]}M{lengths[k, m]}{kinds[k, m]}")
+        parts.append(f"{blocks[k, -1]}M")
+        cigars.append("".join(parts))
+    return cigars
+
+def generateSam(file, reads=100000, read_length=100, operations=1, layout="name", chromosomes=3, seed=0,
+                separator='-'):
+    """
+    Write a synthetic SAM file whose reads pass the checks of the format.
+
+    Args:
+        file (str): The path of the SAM file.
+        reads (int): The number of reads.
+        read_length (int): The length of every read.
+        operations (int): The number of insertions and deletions of each CIGAR (0 for only matches).
+        layout (str): "name" for the mates next to each other, "coordinate" for the reads sorted by chromosome
+                      and position (the mates apart) or "single" for reads without mate.
+        chromosomes (int): The number of chromosomes, named chr1, chr2... and prefixing QNAME.
+        seed (int): The seed of the random draws.
+        separator (str): The separator of the chromosome in QNAME.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    rng = np.random.default_rng(seed)
+    paired = layout != "single"
+    insert = 3 * read_length
+    length = max(reads * read_length // max(chromosomes, 1) // 20, 10 * insert)  # Depth of about 20
+
+    # One template per pair (or per read), its mates follow each other
+    templates = reads // 2 if paired else reads
+    chromosome = rng.integers(0, chromosomes, size=templates)
+    start = rng.integers(1, length - insert, size=templates)
+    mapq = rng.integers(0, 61, size=templates)
+    unmapped = rng.random(templates) < 0.05
+    proper = ~unmapped & (rng.random(templates) < 0.8)
+    if paired:  # Interleave the mates
+        chromosome, mapq = np.repeat(chromosome, 2), np.repeat(mapq, 2)
+        mate_start = start + insert - read_length
+        pos = np.column_stack((start, mate_start)).ravel()
+        pnext = np.column_stack((mate_start, start)).ravel()
+        tlen = np.tile([insert, -insert], templates)
+        flag = np.tile([PAIRED | FIRST | MATE_REVERSE, PAIRED | LAST | REVERSE], templates)
+        flag |= np.repeat(np.where(proper, PROPER_PAIR, 0), 2)
+        flag |= np.repeat(np.where(unmapped, UNMAPPED | MATE_UNMAPPED, 0), 2)
+        name = np.repeat(np.arange(templates), 2)
+    else:
+        pos, pnext, tlen, name = start, np.zeros(templates, dtype=np.int64), np.zeros(templates, dtype=np.int64), \
+            np.arange(templates)
+        flag = np.where(unmapped, UNMAPPED, 0)
+    mapq = np.where(flag & UNMAPPED, 0, mapq)
+    order = np.lexsort((pos, chromosome)) if layout == "coordinate" else np.arange(len(pos))
+
+    names = [f"chr{c + 1}" for c in range(chromosomes)]
+    written = 0
+    with open(file, "w") as f:
+        f.write("@HD\tVN:1.6\tSO:" + ("coordinate" if layout == "coordinate" else "unsorted") + "\n")
+        for c in names:
+            f.write(f"@SQ\tSN:{c}\tLN:{length}\n")
+        for begin in range(0, len(order), GENERATOR_BLOCK):
+            block = order[begin:begin + GENERATOR_BLOCK]
+            cigars = syntheticCigars(rng, len(block), read_length, operations)
+            bases = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, size=(len(block), read_length))]
+            quality = "I" * read_length
+            lines = []
+            for k, n in enumerate(block.tolist()):
+                unmapped_read = flag[n] & UNMAPPED
+                lines.append(f"{names[chromosome[n]]}{separator}{name[n]}\t{flag[n]}\t{names[chromosome[n]]}\t{pos[n]}\t"
+                             f"{mapq[n]}\t{'*' if unmapped_read else cigars[k]}\t{'=' if paired else '*'}\t"
+                             f"{pnext[n]}\t{tlen[n] if not unmapped_read else 0}\t{bases[k].tobytes().decode()}\t"
+                             f"{quality}\n")
+            text = "".join(lines)
+            f.write(text)
+            written += len(text)
+    return written
+
+#### Measures ####
+def resetPeak():
+    """
+    Reset the peak resident memory of the process, where Linux allows it, so that each stage has its own peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peakRss():
+    """
+    Peak resident memory of the process in MB, since the last resetPeak when the kernel supports it.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+def measure(measures, stage, items, unit, seconds):
+    measures[stage] = {"items": int(items), "unit": unit, "seconds": seconds,
+                       "rate": items / seconds if seconds > 0 else float("inf"), "peak_rss_mb": peakRss()}
+
+def timed(function, *args, **kwargs):
+    """
+    Call a function and time it.
+
+    Returns:
+        tuple: The result and the elapsed seconds.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def sampleLines(file, limit):
+    """
+    Read the first records of a SAM file as lists of columns, as check_line receives them.
+    """
+    lines = []
+    with open(file, "r") as f:
+        for line in f:
+            if line.startswith("@"): continue
+            lines.append(line.rstrip("\n").split("\t"))
+            if len(lines) >= limit: break
+    return lines
+
+#### Stages ####
+def runBenchmark(file, threads=1, sample=200000, verbose=False):
+    """
+    Time each stage of the analysis of a SAM file on its own, with the settings of config.yaml.
+    The per-record stages (check_line, readCigar) run on the first sample records, the per-batch stages
+    (readMapping, globalPercentCigar) on every batch, the batches being read beforehand.
+
+    Args:
+        file (str): The path of the SAM file.
+        threads (int): The number of processes of the checkFormat stage.
+        sample (int): The number of records of the per-record stages.
+        verbose (bool): If True, tell which stage runs.
+
+    Returns:
+        dict: For each stage, the number of items processed, their unit, the seconds, the items per second
+              and the peak resident memory (MB).
+    """
+    config = loadConfig()
+    modules = loadModules(config['version'])
+    analyse, checks = modules["analyse"], modules["checks"]
+    measures = {}
+
+    def log(stage):
+        if verbose: print(f"Benchmarking {stage}", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as work:
+        cwd = os.getcwd()
+        os.chdir(work)  # The plots and the pages are written in ./temp, as by main.py
+        try:
+            os.makedirs("temp", exist_ok=True)
+            results_dir = os.path.join(work, "results")  # The pages are written there
+            os.makedirs(results_dir, exist_ok=True)
+
+            # A file failing the checks would only time their error path
+            faulty = next((line for line in sampleLines(file, sample) if not checks.valid_line(line)), None)
+            if faulty is not None:
+                print(f"The record {faulty[0]} of {file} does not pass the checks of the format, "
+                      f"it cannot be benchmarked.")
+                sys.exit(2)
+
+            log("checkFormat")
+            resetPeak()
+            (accumulators, total_lines), seconds = timed(
+                checkFormat, file, checks, analyse, results_dir, trusted=False, separator=config['separator'],
+                maq_threshold=config['mapq threshold'], chunk_size=config['chunk size'],
+                mapq_classes=config['mapq histogram'], threads=threads, version=config['version'])
+            reads = sum(total_lines.values())
+            measure(measures, "checkFormat", reads, "reads", seconds)
+
+            log("check_line")
+            lines = sampleLines(file, sample)
+            resetPeak()
+            _, seconds = timed(lambda: [checks.check_line(line) for line in lines])
+            measure(measures, "check_line", len(lines), "reads", seconds)
+
+            log("readCigar")
+            cigars = [line[5] for line in lines]
+            del lines
+            resetPeak()
+            _, seconds = timed(lambda: [analyse.readCigar(cigar) for cigar in cigars])
+            measure(measures, "readCigar", len(cigars), "reads", seconds)
+            del cigars
+
+            # The batches are read once, only the analyses are timed
+            batches = list(scanSam(file, with_seq=bool(config['fasta export'])))
+            reads_in_batches = sum(batch["size"] for batch in batches)
+
+            log("readMapping")
+            resetPeak()
+            mates = {}
+            seconds = sum(timed(analyse.readMapping, batch, os.path.join(work, "mapping"), verbose=False,
+                                mates=mates)[1] for batch in batches)
+            measure(measures, "readMapping", reads_in_batches, "reads", seconds)
+
+            log("globalPercentCigar")
+            resetPeak()
+            coverage, mapq = newTrack(0, np.int32), {"sum": newTrack(0, np.int64), "histogram": None}
+            seconds = 0
+            for batch in batches:
+                (_, coverage, mapq), elapsed = timed(analyse.globalPercentCigar, batch, coverage, mapq)
+                seconds += elapsed
+            measure(measures, "globalPercentCigar", reads_in_batches, "reads", seconds)
+            del batches, coverage, mapq
+
+            log("plot_depth_mapq")
+            from plotit import plot_depth_mapq
+            resetPeak()
+            positions, seconds, images = 0, 0, {}
+            for n, (chromosome, accumulator) in enumerate(accumulators.items()):
+                depth, mapq = analyse.finalizeAccumulator(accumulator)
+                first, last = coveredSpan([depth, mapq])
+                depth, mapq = denseTrack(depth, first, last), denseTrack(mapq, first, last)
+                images[chromosome] = f"temp/chromosome_{n}.png"
+                _, elapsed = timed(plot_depth_mapq, depth, mapq, bins=config['bins'],
+                                   depth_median=config['calculation method']['depth'] == "median",
+                                   mapq_median=config['calculation method']['mapq'] == "median",
+                                   n_ticks=config['n ticks'], path=images[chromosome], offset=first)
+                positions += len(depth)
+                seconds += elapsed
+            measure(measures, "plot_depth_mapq", positions, "positions", seconds)
+
+            log("summarize")
+            summarize = modules["summarize"].summarize
+            resetPeak()
+            start = time.perf_counter()
+            total = None
+            for chromosome, accumulator in accumulators.items():
+                results = chromosomeResults(accumulator, total_lines[chromosome], config['mapq threshold'])
+                summarize(chromosome, results, results_dir, image=images[chromosome])
+                total = results if total is None else {key: total[key] + results[key] for key in total}
+            from plotit import plot_mapping_ratio
+            plot_mapping_ratio({chromosome: accumulator["results"] for chromosome, accumulator in accumulators.items()})
+            total['chromosomes'] = accumulators.keys()
+            try:
+                summarize("benchmark", total, results_dir, genome=True, workers=threads)
+                measure(measures, "summarize", len(accumulators) + 1, "pages", time.perf_counter() - start)
+            except (OSError, subprocess.SubprocessError) as error:  # No LaTeX here
+                print(f"The summarize stage is skipped: {error}", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    return measures
+
+#### Report ####
+def printMeasures(measures, baseline=None, tolerance=0.1):
+    """
+    Print the measures as a table, with the change of the rate of each stage against a baseline.
+
+    Returns:
+        list: The stages slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    print(f"{'stage':<20}{'items':>12} {'unit':<10}{'seconds':>10}{'items/s':>14}{'peak RSS':>12}"
+          + ("      change" if baseline else ""))
+    for stage in STAGES:
+        if stage not in measures: continue
+        values = measures[stage]
+        line = (f"{stage:<20}{values['items']:>12} {values['unit']:<10}{values['seconds']:>10.3f}"
+                f"{values['rate']:>14,.0f}{values['peak_rss_mb']:>9.0f} MB")
+        if baseline and stage in baseline.get("stages", {}):
+            change = values["rate"] / baseline["stages"][stage]["rate"] - 1
+            line += f"{change:>+11.1%}"
+            if change < -tolerance:
+                regressions.append(stage)
+                line += "  regression"
+        print(line)
+    return regressions
+
+def main(argv):
+    """
+        Generate a synthetic SAM file (or take the given one), time each stage and report the measures
+    """
+    try:
+        opts, _ = getopt.getopt(argv, "hi:r:l:c:y:n:s:k:p:o:b:t:v",
+                                ["help", "input=", "reads=", "read-length=", "cigar=", "layout=", "chromosomes=",
+                                 "seed=", "keep=", "threads=", "output=", "baseline=", "tolerance=", "verbose"])
+    except getopt.GetoptError as error:
+        print(error)
+        print(USAGE)
+        sys.exit(2)
+
+    settings = {"reads": 100000, "read_length": 100, "operations": 1, "layout": "name", "chromosomes": 3, "seed": 0}
+    inputfile, keep, threads, output, baseline, tolerance, verbose = None, None, 1, None, None, 0.1, False
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(USAGE)
+            sys.exit()
+        elif opt in ("-i", "--input"): inputfile = arg
+        elif opt in ("-r", "--reads"): settings["reads"] = int(arg)
+        elif opt in ("-l", "--read-length"): settings["read_length"] = int(arg)
+        elif opt in ("-c", "--cigar"): settings["operations"] = int(arg)
+        elif opt in ("-y", "--layout"): settings["layout"] = arg
+        elif opt in ("-n", "--chromosomes"): settings["chromosomes"] = int(arg)
+        elif opt in ("-s", "--seed"): settings["seed"] = int(arg)
+        elif opt in ("-k", "--keep"): keep = arg
+        elif opt in ("-p", "--threads"): threads = max(int(arg), 1)
+        elif opt in ("-o", "--output"): output = arg
+        elif opt in ("-b", "--baseline"): baseline = json.load(open(arg))
+        elif opt in ("-t", "--tolerance"): tolerance = float(arg)
+        elif opt in ("-v", "--verbose"): verbose = True
+    if settings["read_length"] < 2 * settings["operations"] + 1:  # A match around each insertion or deletion
+        print(f"The reads are too short for {settings['operations']} insertions and deletions, "
+              f"they need at least {2 * settings['operations'] + 1} bases.")
+        sys.exit(2)
+    if settings["layout"] not in ("name", "coordinate", "single"):
+        print(f"The layout {settings['layout']} is not supported. Please choose name, coordinate or single.")
+        sys.exit(2)
+
+    with tempfile.TemporaryDirectory() as work:
+        measures = {}
+        file = inputfile
+        if file is None:
+            file = os.path.abspath(keep) if keep else os.path.join(work, "synthetic.sam")
+            if verbose: print(f"Generating {settings['reads']} reads in {file}", file=sys.stderr)
+            resetPeak()
+            _, seconds = timed(generateSam, file, separator=loadConfig()['separator'], **settings)
+            measure(measures, "generate", settings["reads"], "reads", seconds)
+        measures.update(runBenchmark(os.path.abspath(file), threads=threads, verbose=verbose))
+
+    if baseline and (baseline.get("input"), baseline.get("settings")) != (inputfile, settings if inputfile is None else None):
+        print("The baseline was measured on another input, the rates may not be comparable.")
+    regressions = printMeasures(measures, baseline, tolerance)
+    if output:
+        with open(output, "w") as f:
+            json.dump({"input": inputfile, "settings": settings if inputfile is None else None, "threads": threads,
+                       "stages": measures}, f, indent=2)
+    if regressions:
+        print(f"Regression of {', '.join(regressions)} beyond {tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from coverage import newTrack, sparseTrack, addSparse
+
+# Changed whenever the content of the accumulators changes, so that older entries are not reused
+CACHE_VERSION = 4
+# Bytes of the input file hashed at its start, its middle and its end
+SAMPLE_BYTES = 1 << 20
+# FASTA files written next to the accumulators, plain or gzipped, they have to be unchanged to reuse an entry
+FASTA_FILES = [f"only_{name}.fasta{extension}" for name in ["partially_mapped", "unmapped", "mapped"]
+               for extension in ["", ".gz"]]
+
+def cacheDirectory(config):
+    """
+    Directory of the caches: the cache dir of the config, else the cache directory of the user ($XDG_CACHE_HOME,
+    ~/.cache by default), so that an install in a read-only or shared directory can still cache its analyses.
+    """
+    directory = config.get('cache dir') or os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                                                        os.path.join(os.path.expanduser("~"), ".cache"), "samReader")
+    return os.path.expanduser(directory)
+
+def cacheKey(file, settings):
+    """
+    Key of the analyses of a file: its size, its modification time and a hash of samples of its content,
+    with the settings changing the analyses.
+
+    Args:
+        file (str): The path of the input file.
+        settings (dict): The settings the accumulators depend on (version, separator, thresholds, region...).
+
+    Returns:
+        str: The hexadecimal key of the entry.
+    """
+    stat = os.stat(file)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps({"version": CACHE_VERSION, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                              "settings": settings}, sort_keys=True, default=str).encode())
+    with open(file, "rb") as f:
+        for offset in (0, max(stat.st_size // 2 - SAMPLE_BYTES // 2, 0), max(stat.st_size - SAMPLE_BYTES, 0)):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+def fastaState(path):
+    """
+    Size and modification time of the FASTA files of a chromosome, None for the missing ones.
+    """
+    state = []
+    for name in FASTA_FILES:
+        fasta = os.path.join(path, name)
+        stat = os.stat(fasta) if os.path.exists(fasta) else None
+        state.append(None if stat is None else [stat.st_size, stat.st_mtime_ns])
+    return state
+
+def loadTrack(shape, indices, values):
+    """
+    Rebuild a track stored by its shape and its non-zero values (see coverage.sparseTrack).
+    """
+    track = newTrack(int(shape[0]), values.dtype, tuple(int(n) for n in shape[1:]))
+    addSparse(track, shape, indices, values)
+    return track
+
+def newEntry(cache_dir, key):
+    """
+    Start an entry of the cache, written chromosome after chromosome (see addChromosome) in a file aside, renamed
+    by closeEntry, so that an interrupted run does not leave a broken entry.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        key (str): The key given by cacheKey.
+
+    Returns:
+        dict: The entry, without file when the cache cannot be written (read-only or full directory).
+    """
+    entry = {"cache_dir": cache_dir, "path": os.path.join(cache_dir, f"{key}.npz"), "chromosomes": [], "file": None}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        entry["file"] = zipfile.ZipFile(f"{entry['path']}.part", "w", zipfile.ZIP_DEFLATED)
+    except OSError:
+        dropEntry(entry)
+    return entry
+
+def writeArray(entry, name, array):
+    """
+    Write an array in the file of an entry, as numpy.savez_compressed does, so that numpy.load reads it back.
+    """
+    with entry["file"].open(f"{name}.npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+def addChromosome(entry, chromosome, accumulator):
+    """
+    Write the accumulator of a chromosome in an entry of the cache, once all its reads are accumulated: its tracks
+    can then be released. The entry is dropped when it cannot be written.
+
+    Args:
+        entry (dict): The entry given by newEntry.
+        chromosome (str): The name of the chromosome.
+        accumulator (dict): Its accumulator (see analyse.newAccumulator).
+    """
+    if entry["file"] is None: return
+    n = len(entry["chromosomes"])
+    entry["chromosomes"].append({"name": chromosome,
+                                 "path": accumulator["path"],
+                                 "results": accumulator["results"],
+                                 "cigar": {mutation: float(value) for mutation, value in accumulator["cigar"].items()},
+                                 "flags": accumulator["flags"],
+                                 "histogram": accumulator["mapq"]["histogram"] is not None})
+    tracks = {"coverage": accumulator["coverage"], "mapq_sum": accumulator["mapq"]["sum"]}
+    if accumulator["mapq"]["histogram"] is not None: tracks["mapq_histogram"] = accumulator["mapq"]["histogram"]
+    try:
+        for name, track in tracks.items():  # Only the non-zero values of the difference tracks
+            for part, array in zip(("shape", "indices", "values"), sparseTrack(track)):
+                writeArray(entry, f"{n}_{name}_{part}", array)
+    except OSError:  # The analyses are only used for this run
+        dropEntry(entry)
+
+def closeEntry(entry, total_lines, checked, max_bytes):
+    """
+    Complete an entry of the cache, then evict the least recently used entries until the cache holds at most max_bytes.
+
+    Args:
+        entry (dict): The entry given by newEntry, holding every chromosome.
+        total_lines (dict): The number of reads of each chromosome.
+        checked (bool): Whether the format of the input file was checked.
+        max_bytes (int): The maximal size of the cache.
+
+    Returns:
+        bool: Whether the entry is stored, not when the cache cannot be written (read-only or full directory).
+    """
+    if entry["file"] is None: return False
+    for chromosome in entry["chromosomes"]:  # Once the FASTA files are all written
+        chromosome["fasta"] = fastaState(chromosome["path"])
+    meta = {"total_lines": total_lines, "checked": checked, "chromosomes": entry["chromosomes"]}
+    try:
+        writeArray(entry, "meta", np.array(json.dumps(meta)))
+        entry["file"].close()
+        os.replace(f"{entry['path']}.part", entry["path"])
+        evict(entry["cache_dir"], max_bytes)
+    except OSError:  # The analyses are only used for this run
+        dropEntry(entry)
+        return False
+    return True
+
+def dropEntry(entry):
+    """
+    Give up an entry of the cache, removing what is already written.
+    """
+    try:
+        if entry["file"] is not None: entry["file"].close()
+    except OSError:
+        pass
+    entry["file"] = None
+    if os.path.exists(f"{entry['path']}.part"): os.remove(f"{entry['path']}.part")
+
+def storeResults(cache_dir, key, accumulators, total_lines, checked, max_bytes):
+    """
+    Store the accumulators of an analysis in the cache at once (see newEntry), then evict the least recently used
+    entries until the cache holds at most max_bytes.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        key (str): The key given by cacheKey.
+        accumulators (dict): The accumulators of the chromosomes (see analyse.newAccumulator), once complete.
+        total_lines (dict): The number of reads of each chromosome.
+        checked (bool): Whether the format of the input file was checked.
+        max_bytes (int): The maximal size of the cache.
+
+    Returns:
+        bool: Whether the entry is stored, not when the cache cannot be written (read-only or full directory).
+    """
+    entry = newEntry(cache_dir, key)
+    for chromosome, accumulator in accumulators.items():
+        addChromosome(entry, chromosome, accumulator)
+    return closeEntry(entry, total_lines, checked, max_bytes)
+
+def loadResults(cache_dir, key, trusted=False):
+    """
+    Load the accumulators of an analysis from the cache.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        key (str): The key given by cacheKey.
+        trusted (bool): Whether an entry of an input file that was not checked can be used.
+
+    Returns:
+        tuple: The accumulators and the number of reads of each chromosome, None if the entry is missing,
+               if the input file was not checked while it has to be, or if its FASTA files have changed.
+    """
+    path = os.path.join(cache_dir, f"{key}.npz")
+    if not os.path.exists(path): return None
+
+    with np.load(path) as stored:
+        meta = json.loads(str(stored["meta"]))
+        if not (meta["checked"] or trusted): return None
+
+        accumulators = {}
+        for n, chromosome in enumerate(meta["chromosomes"]):
+            if fastaState(chromosome["path"]) != chromosome["fasta"]: return None
+
+            def track(name):
+                return loadTrack(stored[f"{n}_{name}_shape"], stored[f"{n}_{name}_indices"],
+                                 stored[f"{n}_{name}_values"])
+
+            accumulators[chromosome["name"]] = {
+                "path": chromosome["path"],
+                "results": chromosome["results"],
+                "cigar": chromosome["cigar"],
+                "flags": chromosome["flags"],
+                "coverage": track("coverage"),
+                "mapq": {"sum": track("mapq_sum"),
+                         "histogram": track("mapq_histogram") if chromosome["histogram"] else None}}
+
+    try:
+        os.utime(path)  # Most recently used
+    except OSError:  # Cache shared read-only
+        pass
+    return accumulators, meta["total_lines"]
+
+def evict(cache_dir, max_bytes, extension=".npz"):
+    """
+    Remove the least recently used entries (files ending with extension) of the cache until it holds at most max_bytes.
+    The entries removed meanwhile by another run sharing the cache are skipped.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(extension): continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, name)))
+    entries.sort()
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry in entries:
+        if size <= max_bytes: break
+        size -= entry_size
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
@@ -1,3 +1,24 @@
+from array import array
+from functools import cache
+import os
+import numpy as np
+
+# Directory of the scripts, holding config.yaml
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+#### Settings ####
+@cache
+def loadYaml(path):
+    """
+    Parse a YAML file once per process, the modules reading the same file share the result (which is not modified).
+    """
+    import yaml  # Only imported once a file is read
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))  # The C parser when available
+
+def loadConfig():
+    return loadYaml(os.path.join(ROOT, "config.yaml"))
+
 #### Convert to binary ####
 def toBinary(load, exponent):
     flagB = bin(int(load)).replace('0b', '')  # Convert to binary and remove '0b'
@@ -10,3 +31,115 @@ def toBinary(load, exponent):
     # Adjust size to exponent
     flagB = ['0'] * (exponent - len(flagB)) + list(flagB[starting_index:])
     return "".join(flagB)  # Return binary flag
+
+#### Columnar store of the records ####
+# Typed columns: name -> (index of the column in a SAM line, typecode of the array)
+NUMERIC_COLUMNS = {"flag": (1, 'H'), "pos": (3, 'q'), "mapq": (4, 'B'), "tlen": (8, 'i')}
+# Text columns, stored one after another in a byte buffer with the offset of each end
+TEXT_COLUMNS = {"qname": 0, "cigar": 5, "seq": 9, "qual": 10}
+
+def newRecordStore():
+    """
+    Create an empty columnar store of records, filled line by line with appendRecord.
+
+    Returns:
+        dict: A typed array per numeric column and a (bytearray, offsets) couple per text column.
+    """
+    store = {column: array(typecode) for column, (_, typecode) in NUMERIC_COLUMNS.items()}
+    store.update({column: (bytearray(), array('q', [0])) for column in TEXT_COLUMNS})
+    return store
+
+def appendRecord(store, line):
+    """
+    Add a record (the list of the columns of a SAM line, FLAG already converted to int) to a store.
+    The CIGAR of the unmapped reads ("*") is stored empty.
+    """
+    for column, (index, _) in NUMERIC_COLUMNS.items():
+        store[column].append(int(line[index]))
+    for column, index in TEXT_COLUMNS.items():
+        buffer, offsets = store[column]
+        if column != "cigar" or line[index] != "*":
+            buffer += line[index].encode()
+        offsets.append(len(buffer))
+
+def storeSize(store):
+    return len(store["flag"])
+
+def toBatch(store):
+    """
+    View a store as a batch of NumPy arrays, without copying it.
+
+    Returns:
+        dict: "size" the number of records, a NumPy array per numeric column and, per text column,
+              a (uint8 buffer, int64 offsets) couple where the record n spans buffer[offsets[n]:offsets[n + 1]].
+    """
+    batch = {"size": storeSize(store)}
+    for column, (_, typecode) in NUMERIC_COLUMNS.items():
+        batch[column] = np.frombuffer(store[column], dtype=np.dtype(typecode))
+    for column in TEXT_COLUMNS:
+        buffer, offsets = store[column]
+        batch[column] = (np.frombuffer(buffer, dtype=np.uint8), np.frombuffer(offsets, dtype=np.int64))
+    return batch
+
+def getText(batch, column, n):
+    """
+    Get the text of the record n in a text column of a batch.
+    """
+    buffer, offsets = batch[column]
+    return buffer[offsets[n]:offsets[n + 1]].tobytes().decode()
+
+def gatherRagged(buffer, starts, lengths):
+    """
+    Gather variable-length slices of a buffer one after another.
+
+    Args:
+        buffer (numpy.ndarray): The buffer to read.
+        starts (numpy.ndarray): The start of each slice in the buffer.
+        lengths (numpy.ndarray): The length of each slice.
+
+    Returns:
+        tuple: The gathered values and the offsets of the slices in them (one more than the number of slices).
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    index = np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return buffer[index], offsets
+
+def takeBatch(batch, indices):
+    """
+    Select some records of a batch, in the given order.
+    """
+    taken = {"size": len(indices)}
+    for column, values in batch.items():
+        if column == "size": continue
+        if isinstance(values, tuple):  # Variable-length column
+            buffer, offsets = values
+            taken[column] = gatherRagged(buffer, offsets[indices], offsets[indices + 1] - offsets[indices])
+        else:
+            taken[column] = values[indices]
+    return taken
+
+def concatBatches(batches):
+    """
+    Put several batches holding the same columns one after another.
+    """
+    if len(batches) == 1: return batches[0]
+    merged = {"size": sum(batch["size"] for batch in batches)}
+    for column, values in batches[0].items():
+        if column == "size": continue
+        if isinstance(values, tuple):  # Variable-length column, the offsets are shifted by the previous buffers
+            shift = np.cumsum([0] + [len(batch[column][0]) for batch in batches[:-1]])
+            merged[column] = (np.concatenate([batch[column][0] for batch in batches]),
+                              np.concatenate([batches[0][column][1][:1]] +
+                                             [batch[column][1][1:] + shift[n] for n, batch in enumerate(batches)]))
+        else:
+            merged[column] = np.concatenate([batch[column] for batch in batches])
+    return merged
+
+def textList(batch, column):
+    """
+    Get every text of a text column of a batch as a list of str.
+    """
+    buffer, offsets = batch[column]
+    data = buffer.tobytes().decode("latin-1")  # One character per byte, so that the offsets stay valid
+    return [data[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
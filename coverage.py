@@ -0,0 +1,345 @@
+import numpy as np
+
+# Largest table of counts (bins x distinct values) used to sort integer tracks by counting
+COUNTING_LIMIT = 1 << 26
+# Number of windows of a level of the pyramid merged into one window of the next level
+PYRAMID_FACTOR = 4
+# Positions of a chunk of a chunked track
+TRACK_CHUNK = 1 << 18
+
+def binEdges(length, bins):
+    """
+    Split length positions in bins of about the same size, as the plots do.
+
+    Returns:
+        numpy.ndarray: The bins + 1 edges, bin i covering the positions edges[i] to edges[i + 1] (excluded).
+    """
+    return np.linspace(0, length, bins + 1, dtype=np.int64)
+
+def binnedSums(values, edges, power=1, chunk=1 << 22):
+    """
+    Sum the values (raised to a power) of each bin with reduceat, chunk after chunk so that only a chunk of the track
+    is converted at once. The empty bins sum to 0.
+    """
+    sums = np.zeros(len(edges) - 1)
+    for begin in range(0, len(values), chunk):
+        block = values[begin:begin + chunk]
+        if power != 1: block = np.power(block, power, dtype=np.float64)
+        starts, segment_bin = chunkSegments(edges, begin, len(block))
+        np.add.at(sums, segment_bin, np.add.reduceat(block, starts, dtype=np.float64))
+    return sums
+
+def chunkSegments(edges, begin, length):
+    """
+    Split a chunk of a track by the bins starting inside it.
+
+    Returns:
+        tuple: The start of each segment in the chunk and its bin, the first segment going on the bin started before.
+    """
+    inside = np.unique(edges[(edges > begin) & (edges < begin + length)]) - begin
+    starts = np.concatenate(([0], inside))
+    return starts, np.searchsorted(edges, starts + begin, side="right") - 1
+
+def binnedStatistics(values, edges):
+    """
+    Compute the mean and the standard deviation of the values of each bin.
+
+    Args:
+        values (numpy.ndarray): A track, one value per position.
+        edges (numpy.ndarray): The edges of the bins (see binEdges).
+
+    Returns:
+        tuple: The mean and the standard deviation of each bin, NaN for the empty ones.
+    """
+    counts = np.diff(edges)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(counts > 0, binnedSums(values, edges) / counts, np.nan)
+        square = binnedSums(values, edges, power=2) / counts
+    return mean, np.sqrt(np.maximum(square - mean ** 2, 0))
+
+def sortedWithinBins(values, edges, chunk=1 << 22):
+    """
+    Sort the values of each bin, the bins staying in their order.
+    Integer tracks with few distinct values (the depth) are counted instead of being sorted: a table of the number
+    of positions of each bin having each value is filled chunk after chunk, and the sorted values are read from its
+    cumulative sum without being written out. The other tracks are sorted bin by bin.
+
+    Returns:
+        callable: Gives the values at the requested ranks of the sorted track.
+    """
+    counts = np.diff(edges)
+    if np.issubdtype(values.dtype, np.integer) and len(values) > 0:
+        low, high = int(values.min()), int(values.max())
+        distinct = high - low + 1
+        if len(counts) * distinct <= COUNTING_LIMIT:
+            table = np.zeros(len(counts) * distinct, dtype=np.int64)
+            for begin in range(0, len(values), chunk):
+                block = values[begin:begin + chunk]
+                starts, segment_bin = chunkSegments(edges, begin, len(block))
+                bin_id = np.repeat(segment_bin, np.diff(np.append(starts, len(block))))
+                table += np.bincount(bin_id * distinct + (block - low), minlength=len(table))
+            cumulative = np.cumsum(table)
+            return lambda ranks: low + np.searchsorted(cumulative, ranks, side="right") % distinct
+
+    ordered = np.empty(len(values), dtype=np.float64)
+    for start, end in zip(edges[:-1], edges[1:]):
+        ordered[start:end] = np.sort(values[start:end])
+    return lambda ranks: ordered[ranks]
+
+def binnedQuantiles(values, edges, quantiles):
+    """
+    Compute quantiles of the values of each bin, interpolated as numpy.percentile does, from a single sort.
+
+    Args:
+        values (numpy.ndarray): A track, one value per position.
+        edges (numpy.ndarray): The edges of the bins (see binEdges).
+        quantiles (list[float]): The quantiles to compute, between 0 and 1.
+
+    Returns:
+        numpy.ndarray: One row per quantile and one column per bin, NaN for the empty bins.
+    """
+    counts = np.diff(edges)
+    result = np.full((len(quantiles), len(counts)), np.nan)
+    filled = counts > 0
+    if not filled.any(): return result
+
+    ordered = sortedWithinBins(values, edges)
+    start, count = edges[:-1][filled], counts[filled]
+    for n, quantile in enumerate(quantiles):
+        position = quantile * (count - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, count - 1)
+        t = position - low
+        a, b = ordered(start + low).astype(np.float64), ordered(start + high).astype(np.float64)
+        # Same interpolation as numpy, exact at both ends
+        result[n, filled] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    return result
+
+def summarizeTrack(values, bins, median=True):
+    """
+    Summarize a track in bins for the plots.
+
+    Args:
+        values (numpy.ndarray): The track, one value per position.
+        bins (int): The number of bins.
+        median (bool): Whether the bins are summarized by their median and interquartile range,
+                       else by their mean plus or minus their standard deviation.
+
+    Returns:
+        tuple: The center, the lower and the upper limit of each bin, NaN for the empty ones.
+    """
+    edges = binEdges(len(values), bins)
+    if median:
+        center, lower, upper = binnedQuantiles(values, edges, [0.5, 0.25, 0.75])
+        return center, lower, upper
+    mean, std = binnedStatistics(values, edges)
+    return mean, mean - std, mean + std
+
+#### Chunked tracks ####
+def newTrack(reference=0, dtype=np.int32, columns=(), chunk=TRACK_CHUNK):
+    """
+    Create a track stored in chunks of positions, a chunk being only allocated once a value is added to it,
+    so that the memory depends on the covered positions and not on the length of the reference.
+
+    Args:
+        reference (int): The number of positions of the reference, 0 if unknown. The chunks are then allocated
+                         at their full size (the last one ending with the reference), else they grow with the values.
+        dtype (numpy.dtype): The type of the values.
+        columns (tuple): The shape of the values of a position, () for a single value.
+        chunk (int): The number of positions of a chunk.
+
+    Returns:
+        dict: The "length" of the track (the reference, or the last position holding a value), the "chunk" size
+              and the "chunks" by index, the chunk i holding the positions i * chunk to (i + 1) * chunk (excluded).
+    """
+    return {"length": reference, "reference": reference, "chunk": chunk, "dtype": np.dtype(dtype),
+            "columns": tuple(columns), "chunks": {}}
+
+def chunkGroups(positions, chunk=TRACK_CHUNK):
+    """
+    Split positions by the chunk holding them, once for all the tracks they are added to.
+
+    Returns:
+        list: The index of each chunk, the indices of its positions in the array and their offsets in the chunk.
+    """
+    if len(positions) == 0: return []
+    index = positions // chunk
+    first, last = int(index.min()), int(index.max())
+    if first == last:  # Sorted reads mostly fall in a single chunk
+        return [(first, slice(None), positions - first * chunk)]
+    index -= first  # Few chunks, sorted by radix
+    order = np.argsort(index.astype(np.uint16) if last - first < 1 << 16 else index, kind="stable")
+    starts = np.flatnonzero(np.diff(index[order])) + 1
+    return [(first + int(index[selected[0]]), selected, positions[selected] - (first + int(index[selected[0]])) * chunk)
+            for selected in np.split(order, starts)]
+
+def chunkArray(track, index, needed):
+    """
+    The chunk of a track, allocated or grown (by doubling) so that it holds at least needed positions.
+    """
+    block = track["chunks"].get(index)
+    if block is not None and len(block) >= needed: return block
+    start = index * track["chunk"]
+    size = min(track["chunk"], max(track["reference"] - start, 0 if block is None else 2 * len(block), needed))
+    grown = np.zeros((size, *track["columns"]), dtype=track["dtype"])
+    if block is not None: grown[:len(block)] = block
+    track["chunks"][index] = grown
+    return grown
+
+def addAt(track, groups, values, columns=None):
+    """
+    Add values at positions of a track, as numpy.add.at does.
+
+    Args:
+        track (dict): The track created by newTrack.
+        groups (list): The positions split by chunk (see chunkGroups).
+        values (numpy.ndarray or int): The value added at each position, or the same value everywhere.
+        columns (numpy.ndarray): The column of each value, for the tracks holding several values per position.
+    """
+    for index, selected, offsets in groups:
+        block = chunkArray(track, index, int(offsets.max()) + 1)
+        # numpy.add.at is only fast with an array of values of the type of the track
+        added = values[selected].astype(track["dtype"], copy=False) if np.ndim(values) else \
+            np.full(len(offsets), values, dtype=track["dtype"])
+        np.add.at(block, offsets if columns is None else (offsets, columns[selected]), added)
+        track["length"] = max(track["length"], index * track["chunk"] + int(offsets.max()) + 1)
+
+def sparseTrack(track):
+    """
+    The non-zero values of a track, to be stored or sent to another process.
+
+    Returns:
+        tuple: The shape of the track as a dense array, the flat indices of the values in it and the values.
+    """
+    width = int(np.prod(track["columns"]))
+    indices, values = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=track["dtype"])]
+    for index in sorted(track["chunks"]):
+        flat = track["chunks"][index].ravel()
+        nonzero = np.flatnonzero(flat)
+        indices.append(nonzero + index * track["chunk"] * width)
+        values.append(flat[nonzero])
+    return np.array([track["length"], *track["columns"]], dtype=np.int64), np.concatenate(indices), \
+        np.concatenate(values)
+
+def addSparse(track, shape, indices, values):
+    """
+    Add the non-zero values of a track (see sparseTrack) to a track of the same columns.
+    """
+    width = int(np.prod(shape[1:]))
+    positions = indices // width
+    addAt(track, chunkGroups(positions, track["chunk"]), values, indices % width if len(shape) > 1 else None)
+    track["length"] = max(track["length"], int(shape[0]))
+
+def denseTrack(track, start=0, end=None):
+    """
+    The values of the positions start to end (excluded) of a track as an array, 0 in the missing chunks.
+    """
+    end = track["length"] if end is None else end
+    dense = np.zeros((max(end - start, 0), *track["columns"]), dtype=track["dtype"])
+    chunk = track["chunk"]
+    for index in range(start // chunk, -(-end // chunk)):
+        block = track["chunks"].get(index)
+        if block is None: continue
+        begin = index * chunk
+        low, high = max(start, begin), min(end, begin + len(block))
+        if low < high: dense[low - start:high - start] = block[low - begin:high - begin]
+    return dense
+
+def coveredSpan(tracks, start=0, end=None):
+    """
+    The first and the last (excluded) position between start and end where one of the tracks is not zero.
+
+    Returns:
+        tuple: The span, (start, start) if every position is zero.
+    """
+    first, last = None, None
+    for track in tracks:
+        stop = track["length"] if end is None else min(end, track["length"])
+        for index, block in track["chunks"].items():
+            begin = index * track["chunk"]
+            nonzero = np.flatnonzero(block[max(start - begin, 0):max(stop - begin, 0)]) + max(start, begin)
+            if len(nonzero) == 0: continue
+            first = nonzero[0] if first is None else min(first, nonzero[0])
+            last = nonzero[-1] + 1 if last is None else max(last, nonzero[-1] + 1)
+    return (start, start) if first is None else (int(first), int(last))
+
+#### Pyramids ####
+def buildPyramid(tracks, factor=PYRAMID_FACTOR, min_windows=1, chunk=1 << 22):
+    """
+    Build a multiresolution pyramid of tracks: each level holds the statistics of windows of factor ** level
+    positions. Only the first level reads the positions, chunk after chunk, the next ones are computed from
+    the level below.
+
+    Args:
+        tracks (dict): The tracks by name, one value per position.
+        factor (int): The number of windows of a level merged in a window of the next level.
+        min_windows (int): The levels stop once they have at most this number of windows.
+
+    Returns:
+        dict: For each level and track, "<track>_<level>_<statistic>" arrays of the sum, the sum of the squares,
+              the minimum and the maximum of each window, and "<level>_count" the number of positions of each window.
+    """
+    length = max((len(values) for values in tracks.values()), default=0)
+    pyramid = {"factor": np.array(factor), "length": np.array(length)}
+    if length <= min_windows:
+        pyramid["levels"] = np.array(0)
+        return pyramid
+
+    # First level, the chunks hold whole windows
+    chunk -= chunk % factor
+    level = {}
+    for name, values in tracks.items():
+        parts = []
+        for begin in range(0, len(values), chunk):
+            block = values[begin:begin + chunk]
+            starts = np.arange(0, len(block), factor)
+            parts.append((np.add.reduceat(block, starts, dtype=np.float64),
+                          np.add.reduceat(np.square(block, dtype=np.float64), starts),
+                          np.minimum.reduceat(block, starts), np.maximum.reduceat(block, starts)))
+        level[name] = {statistic: np.concatenate([part[n] for part in parts])
+                       for n, statistic in enumerate(["sum", "square", "min", "max"])}
+    count = np.full(-(-length // factor), factor, dtype=np.int64)
+    count[-1] = length - factor * (len(count) - 1)  # The last window may be shorter
+
+    n = 1
+    while True:
+        for name, statistics in level.items():
+            for statistic, values in statistics.items():
+                pyramid[f"{name}_{n}_{statistic}"] = values
+        pyramid[f"{n}_count"] = count
+        if len(count) <= min_windows: break
+
+        # Next level from the windows of this one
+        n += 1
+        starts = np.arange(0, len(count), factor)
+        count = np.add.reduceat(count, starts)
+        for statistics in level.values():
+            for statistic, reduce in (("sum", np.add), ("square", np.add), ("min", np.minimum), ("max", np.maximum)):
+                statistics[statistic] = reduce.reduceat(statistics[statistic], starts)
+
+    pyramid["levels"] = np.array(n)
+    return pyramid
+
+def writePyramid(path, tracks, factor=PYRAMID_FACTOR):
+    """
+    Write the pyramid of tracks (see buildPyramid) in a .npz file.
+    """
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **buildPyramid(tracks, factor))
+
+def readLevel(path, track, windows):
+    """
+    Read the mean, the standard deviation, the minimum and the maximum of a track from the finest level
+    of a pyramid file holding at most the requested number of windows.
+
+    Returns:
+        tuple: The window size of the level and the dictionary of its statistics.
+    """
+    with np.load(path) as pyramid:
+        factor, levels = int(pyramid["factor"]), int(pyramid["levels"])
+        n = next((n for n in range(1, levels + 1) if len(pyramid[f"{n}_count"]) <= windows), levels)
+        count = pyramid[f"{n}_count"]
+        mean = pyramid[f"{track}_{n}_sum"] / count
+        variance = np.maximum(pyramid[f"{track}_{n}_square"] / count - mean ** 2, 0)
+        return factor ** n, {"mean": mean, "std": np.sqrt(variance),
+                             "min": pyramid[f"{track}_{n}_min"], "max": pyramid[f"{track}_{n}_max"]}
@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+
+from coverage import binEdges, summarizeTrack
+
+# Machine-readable outputs, written instead of the PDF report
+FORMATS = ("json", "tsv", "npz")
+# Columns of the binned depth and MAPQ
+BIN_COLUMNS = ["start", "end", "depth", "depth_lower", "depth_upper", "mapq", "mapq_lower", "mapq_upper"]
+
+def binnedTracks(depth, mapq, bins=100, depth_median=True, mapq_median=True, offset=0):
+    """
+    Summarize the depth and the MAPQ of a chromosome in bins, as in the plot of the report: the positions before
+    the first and after the last covered one are left out.
+
+    Args:
+        depth (numpy.ndarray): The depth of each position.
+        mapq (numpy.ndarray): The MAPQ of each position.
+        bins (int): The number of bins.
+        depth_median (bool): Whether the depth of a bin is its median and interquartile range, else its mean and std.
+        mapq_median (bool): The same for the MAPQ.
+        offset (int): The position of the first value of the tracks, when they only hold a span of the chromosome.
+
+    Returns:
+        dict: One array per column of BIN_COLUMNS, the bin covering the positions start to end (excluded).
+    """
+    covered = np.flatnonzero((depth != 0) | (mapq[:len(depth)] != 0))
+    first, last = (covered[0], covered[-1] + 1) if len(covered) else (0, 0)
+
+    edges = binEdges(last - first, bins)
+    columns = {"start": edges[:-1] + first + offset, "end": edges[1:] + first + offset}
+    columns["depth"], columns["depth_lower"], columns["depth_upper"] = summarizeTrack(depth[first:last], bins,
+                                                                                     median=depth_median)
+    columns["mapq"], columns["mapq_lower"], columns["mapq_upper"] = summarizeTrack(mapq[first:last], bins,
+                                                                                  median=mapq_median)
+    return columns
+
+def writeJson(file, genome, chromosomes):
+    """
+    Write the metrics of the genome and of each chromosome, with its bins, in a JSON file.
+    The empty bins are null.
+    """
+    def column(values):
+        return [None if np.isnan(value) else value for value in np.asarray(values, dtype=np.float64).tolist()]
+
+    content = {"genome": genome,
+               "chromosomes": {name: {**values, "bins": {key: column(array) if key not in ("start", "end")
+                                                        else np.asarray(array).tolist() for key, array in bins.items()}}
+                               for name, (values, bins) in chromosomes.items()}}
+    with open(file, "w") as f:
+        json.dump(content, f, indent=2)
+
+def writeTsv(file_prefix, genome, chromosomes):
+    """
+    Write the metrics in <prefix>_metrics.tsv, one line per chromosome and a last one for the genome,
+    and the bins in <prefix>_bins.tsv, one line per bin. The empty bins are NaN.
+    """
+    names = list(genome)
+    with open(f"{file_prefix}_metrics.tsv", "w") as f:
+        f.write("\t".join(["chromosome", *names]) + "\n")
+        for name, values in [*((name, values) for name, (values, _) in chromosomes.items()), ("genome", genome)]:
+            f.write("\t".join([name, *(str(values[key]) for key in names)]) + "\n")
+
+    with open(f"{file_prefix}_bins.tsv", "w") as f:
+        f.write("\t".join(["chromosome", "bin", *BIN_COLUMNS]) + "\n")
+        for name, (_, bins) in chromosomes.items():
+            for n, row in enumerate(zip(*(bins[key].tolist() for key in BIN_COLUMNS))):
+                f.write("\t".join([name, str(n), *map(str, row)]) + "\n")
+
+def writeNpz(file, genome, chromosomes):
+    """
+    Write the metrics and the bins as columns in a .npz file: "chromosome" and one "metrics/<name>" array with
+    a value per chromosome then the genome, and "bins/chromosome" (index in "chromosome") and one "bins/<column>"
+    array with a value per bin of every chromosome.
+    """
+    names = list(chromosomes)
+    columns = {"chromosome": np.array(names + ["genome"], dtype=str)}
+    for key in genome:
+        columns[f"metrics/{key}"] = np.array([values[key] for values, _ in chromosomes.values()] + [genome[key]])
+
+    columns["bins/chromosome"] = np.concatenate([np.full(len(bins["start"]), n, dtype=np.int32)
+                                                 for n, (_, bins) in enumerate(chromosomes.values())] or
+                                                [np.zeros(0, dtype=np.int32)])
+    for key in BIN_COLUMNS:
+        columns[f"bins/{key}"] = np.concatenate([bins[key] for _, bins in chromosomes.values()] or [np.zeros(0)])
+
+    with open(file, "wb") as f:  # An open file so that numpy does not add the .npz extension twice
+        np.savez_compressed(f, **columns)
+
+def writeMetrics(results_dir, file_name, output_format, genome, chromosomes):
+    """
+    Write the metrics of a run in the requested format.
+
+    Args:
+        results_dir (str): The results directory.
+        file_name (str): The name of the output files, without extension.
+        output_format (str): One of FORMATS.
+        genome (dict): The metrics of the genome (see summarize.metrics).
+        chromosomes (dict): The metrics and the bins (see binnedTracks) of each chromosome.
+
+    Returns:
+        list: The files written.
+    """
+    prefix = os.path.join(results_dir, file_name)
+    if output_format == "json":
+        writeJson(f"{prefix}.json", genome, chromosomes)
+        return [f"{prefix}.json"]
+    if output_format == "tsv":
+        writeTsv(prefix, genome, chromosomes)
+        return [f"{prefix}_metrics.tsv", f"{prefix}_bins.tsv"]
+    writeNpz(f"{prefix}.npz", genome, chromosomes)
+    return [f"{prefix}.npz"]
+
+def writeCohort(file, samples):
+    """
+    Write the metrics of the genome of every sample of a batch in a TSV file, one line per sample.
+
+    Args:
+        file (str): The path of the table.
+        samples (dict): The input file and the metrics of the genome (see summarize.metrics) of each sample, by name.
+    """
+    names = list(next(iter(samples.values()))[1])
+    with open(file, "w") as f:
+        f.write("\t".join(["sample", "input", *names]) + "\n")
+        for sample, (inputfile, values) in samples.items():
+            f.write("\t".join([sample, inputfile, *(str(values[key]) for key in names)]) + "\n")
@@ -0,0 +1,259 @@
+import mmap
+import os
+
+import numpy as np
+
+from common_functions import takeBatch, concatBatches, textList
+from readers import scanSam
+
+# Width of the POS bins of the index, in bases
+INDEX_BIN = 1 << 12
+# Byte ranges closer than this are read as one, skipping a few unrelated records is cheaper than seeking
+MERGE_GAP = 1 << 16
+# The index is stored next to the SAM file, with this extension added to its name
+INDEX_EXTENSION = ".sri"
+# Tables of the index: the chromosome given by the prefix of QNAME and the one given by RNAME
+INDEX_TABLES = ("qname", "rname")
+
+def indexPath(file):
+    return file + INDEX_EXTENSION
+
+def fingerprint(file):
+    """
+    Size and modification time of a file, an index built for other values is out of date.
+    """
+    stat = os.stat(file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+#### Build ####
+def addRuns(table, names, bins, starts, ends, spans):
+    """
+    Add the records of a batch to a table of the index, consecutive records of the same chromosome and bin
+    being stored as a single byte range.
+
+    Args:
+        table (dict): The table, holding the code of each chromosome ("keys"), the longest span of its reads
+                      on the reference ("max_span") and the list of the arrays of runs ("runs").
+        names (list[str]): The chromosome of each record.
+        bins (numpy.ndarray): The POS bin of each record.
+        starts (numpy.ndarray): The byte offset of each record.
+        ends (numpy.ndarray): The byte offset following each record.
+        spans (numpy.ndarray): The number of bases of the reference covered by each record.
+    """
+    codes = np.array([table["keys"].setdefault(name, len(table["keys"])) for name in names], dtype=np.int64)
+    max_span = np.zeros(len(table["keys"]), dtype=np.int64)
+    max_span[:len(table["max_span"])] = table["max_span"]
+    np.maximum.at(max_span, codes, spans)
+    table["max_span"] = max_span
+
+    first = np.flatnonzero(np.concatenate(([True], (np.diff(codes) != 0) | (np.diff(bins) != 0))))
+    last = np.concatenate((first[1:], [len(codes)])) - 1
+    table["runs"].append(np.column_stack((codes[first], bins[first], starts[first], ends[last])))
+
+def mergeRuns(runs):
+    """
+    Merge the runs of a table that follow each other in the file, for the same chromosome and bin.
+
+    Args:
+        runs (list[numpy.ndarray]): The arrays of (code, bin, start, end) runs added by addRuns.
+
+    Returns:
+        numpy.ndarray: The merged runs, sorted by chromosome, bin and start.
+    """
+    runs = np.concatenate(runs) if runs else np.zeros((0, 4), dtype=np.int64)
+    runs = runs[np.lexsort((runs[:, 2], runs[:, 1], runs[:, 0]))]
+    new_run = np.ones(len(runs), dtype=bool)
+    new_run[1:] = (np.diff(runs[:, 0]) != 0) | (np.diff(runs[:, 1]) != 0) | (runs[1:, 2] != runs[:-1, 3])
+    first = np.flatnonzero(new_run)
+    last = np.concatenate((first[1:], [len(runs)])) - 1
+    return np.column_stack((runs[first, :3], runs[last, 3]))
+
+def buildIndex(file, analyse, separator='-'):
+    """
+    Index a SAM file in one pass: for each chromosome, by QNAME prefix and by RNAME, the byte ranges of its records
+    in each bin of POS.
+
+    Args:
+        file (str): The path of the uncompressed SAM file.
+        analyse (module): The analyse module of the SAM version, used to get the span of the reads.
+        separator (str): The separator of the chromosome in QNAME.
+
+    Returns:
+        dict: The arrays of the index, as stored in the index file.
+    """
+    tables = {table: {"keys": {}, "max_span": np.zeros(0, dtype=np.int64), "runs": []} for table in INDEX_TABLES}
+
+    def add(batch, next_offset):
+        ends = np.append(batch["offset"][1:], next_offset)  # A record ends where the next one starts
+        bins = batch["pos"] // INDEX_BIN
+        spans = analyse.referenceSpans(analyse.parseBatchCigars(batch), batch["size"])
+        addRuns(tables["qname"], [name.split(separator)[0] for name in textList(batch, "qname")],
+                bins, batch["offset"], ends, spans)
+        addRuns(tables["rname"], textList(batch, "rname"), bins, batch["offset"], ends, spans)
+
+    # The end of the last record of a batch is only known with the next batch
+    previous = None
+    for batch in scanSam(file, with_seq=False, with_location=True):
+        if previous is not None: add(previous, batch["offset"][0])
+        previous = batch
+    if previous is not None: add(previous, os.path.getsize(file))
+
+    index = {"fingerprint": fingerprint(file), "separator": np.array(separator), "bin": np.array(INDEX_BIN)}
+    for name, table in tables.items():
+        index[f"{name}_keys"] = np.array(list(table["keys"]), dtype=str)
+        index[f"{name}_max_span"] = table["max_span"]
+        index[f"{name}_runs"] = mergeRuns(table["runs"])
+    return index
+
+def loadIndex(file, analyse, separator='-', verbose=False):
+    """
+    Load the index of a SAM file, it is built and stored next to the file when it is missing or out of date.
+    """
+    path = indexPath(file)
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            index = dict(stored)
+        if (np.array_equal(index["fingerprint"], fingerprint(file)) and str(index["separator"]) == separator
+                and int(index["bin"]) == INDEX_BIN):
+            return index
+
+    if verbose: print(f"Indexing {file}")
+    index = buildIndex(file, analyse, separator)
+    try:
+        with open(path, "wb") as f:  # An open file so that numpy does not add the .npz extension
+            np.savez(f, **index)
+    except OSError:  # Read-only directory, the index is only used for this run
+        if verbose: print(f"The index could not be written to {path}")
+    return index
+
+#### Query ####
+def mergeRanges(starts, ends, gap=0):
+    """
+    Merge the byte ranges that overlap or are less than gap bytes apart, sorted by start.
+    """
+    order = np.argsort(starts, kind="stable")
+    starts, ends = np.asarray(starts)[order], np.asarray(ends)[order]
+    if len(starts) == 0: return []
+    reach = np.maximum.accumulate(ends)
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] > reach[:-1] + gap)))
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+    return list(zip(starts[first].tolist(), reach[last].tolist()))
+
+def regionRanges(index, chromosome, start, end):
+    """
+    Find the byte ranges holding the records of a chromosome that may overlap a region.
+
+    Args:
+        index (dict): The index loaded by loadIndex.
+        chromosome (str): The chromosome, looked up by QNAME prefix first, then by RNAME.
+        start (int): The first position of the region (1-based).
+        end (int): The last position of the region (included).
+
+    Returns:
+        tuple: The table where the chromosome was found ("qname" or "rname") and the sorted list of (start, end)
+               byte ranges. The table is None when the chromosome is not indexed.
+    """
+    for table in INDEX_TABLES:
+        keys = index[f"{table}_keys"].tolist()
+        if chromosome in keys: break
+    else:
+        return None, []
+
+    code = keys.index(chromosome)
+    runs = index[f"{table}_runs"]
+    # A read starting before the region may reach it, up to the longest span of the chromosome
+    first_bin = max(start - int(index[f"{table}_max_span"][code]), 0) // INDEX_BIN
+    selected = runs[(runs[:, 0] == code) & (runs[:, 1] >= first_bin) & (runs[:, 1] <= end // INDEX_BIN)]
+    return table, mergeRanges(selected[:, 2], selected[:, 3], MERGE_GAP)
+
+def widenToGroups(file, ranges):
+    """
+    Widen byte ranges so that they hold whole groups of consecutive records of the same QNAME,
+    so that the mates stored next to each other are read together.
+    """
+    with open(file, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def qnameAt(position):  # QNAME of the line starting at position
+        line_end = mapped.find(b"\n", position)
+        line_end = len(mapped) if line_end == -1 else line_end
+        tab = mapped.find(b"\t", position, line_end)
+        return mapped[position:line_end if tab == -1 else tab]
+
+    try:
+        widened = []
+        for start, end in ranges:
+            name = qnameAt(start)
+            while start > 0:  # Move back to the first record of the QNAME
+                previous = mapped.rfind(b"\n", 0, start - 1) + 1
+                if qnameAt(previous) != name: break
+                start = previous
+
+            name = qnameAt(mapped.rfind(b"\n", 0, end - 1) + 1)
+            while end < len(mapped) and qnameAt(end) == name:  # Move on to the last record of the QNAME
+                end = mapped.find(b"\n", end)
+                end = len(mapped) if end == -1 else end + 1
+            widened.append((start, end))
+    finally:
+        mapped.close()
+
+    return mergeRanges([start for start, _ in widened], [end for _, end in widened])
+
+def groupIds(names):
+    """
+    Number the groups of consecutive records of the same QNAME.
+    """
+    names = np.array(names)
+    return np.cumsum(np.concatenate(([0], names[1:] != names[:-1]))) if len(names) else np.zeros(0, dtype=np.int64)
+
+def selectRegion(batch, analyse, table, chromosome, start, end, separator='-'):
+    """
+    Keep the records of a batch whose QNAME group has a read of the chromosome overlapping the region.
+    """
+    names = textList(batch, "qname")
+    spans = analyse.referenceSpans(analyse.parseBatchCigars(batch), batch["size"])
+    inside = (batch["pos"] <= end) & (batch["pos"] + np.maximum(spans, 1) > start)  # Unmapped reads sit at POS
+    if table == "qname":
+        inside &= np.array([name.split(separator)[0] == chromosome for name in names], dtype=bool)
+    else:
+        inside &= np.array(textList(batch, "rname")) == chromosome
+
+    group = groupIds(names)
+    keep = np.bincount(group, weights=inside, minlength=group[-1] + 1 if len(group) else 0) > 0
+    return takeBatch(batch, np.flatnonzero(keep[group]))
+
+def scanRegion(file, analyse, region, separator='-', check_block=None, verbose=False, with_seq=True):
+    """
+    Read only the records of a SAM file overlapping a region, seeking with the index of the file.
+
+    Args:
+        file (str): The path of the uncompressed SAM file.
+        analyse (module): The analyse module of the SAM version.
+        region (tuple): The chromosome, the first and the last position (1-based, included) of the region.
+        separator (str): The separator of the chromosome in QNAME.
+        check_block (callable): The check of the records, see readers.scanSam.
+        verbose (bool): If True, tell when the index is built.
+        with_seq (bool): Whether SEQ is decoded, see readers.scanSam.
+
+    Yields:
+        dict: Batches of records (see common_functions.toBatch), whole QNAME groups having a read in the region.
+    """
+    chromosome, start, end = region
+    table, ranges = regionRanges(loadIndex(file, analyse, separator, verbose), chromosome, start, end)
+    if table is None:
+        raise ValueError(f"The chromosome {chromosome} is not in {file}")
+
+    for range_start, range_end in widenToGroups(file, ranges):
+        carried = None  # The last group of a batch may go on in the next one
+        for batch in scanSam(file, range_start, range_end, with_seq=with_seq, check_block=check_block,
+                             with_location=True):
+            if carried is not None: batch = concatBatches([carried, batch])
+            group = groupIds(textList(batch, "qname"))
+            last = np.searchsorted(group, group[-1])
+            carried = takeBatch(batch, np.arange(last, batch["size"]))
+            selected = selectRegion(takeBatch(batch, np.arange(last)), analyse, table, chromosome, start, end,
+                                    separator)
+            if selected["size"]: yield selected
+        if carried is not None:
+            selected = selectRegion(carried, analyse, table, chromosome, start, end, separator)
+            if selected["size"]: yield selected
@@ -21,11 +21,18 @@ __licence__ ="""This program is free software: you can redistribute it and/or mo
      
     ### OPTION LIST:
         ## -h or --help : help information
-        ## -i or --input: input file (.sam)
+        ## -i or --input: input file (.sam, .sam.gz or .bam)
         ## -o or --output: output name files (.txt)
         ## -t or --trusted: trusted mode (skip the format check)
         ## -v or --verbose: verbose mode
         ## -s or --single: single fasta file mode (only one file for output)
+        ## -p or --threads: number of processes analysing the input file
+        ## -r or --region: region chr:start-end to analyse, read through the index of the input file (.sam)
+        ## -f or --format: output format, pdf (report, default), json, tsv or npz (metrics only, without LaTeX)
+        ## -P or --profile: print the time, the throughput and the peak memory of each stage at the end
+        ## --profile-output <file.json>: write the breakdown of the stages in a JSON file
+        ## --pstats <file>: profile the whole run with cProfile and write the statistics for pstats
+        ## -b or --batch <manifest|glob>: analyse several input files in one process, with a cohort table
 
     #Synopsis:
         ## samReader.sh -h or --help # launch the help.
@@ -34,18 +41,35 @@ __licence__ ="""This program is free software: you can redistribute it and/or mo
         ## samReader.sh -i or --input <file> -t or --trusted # Launch samReader to analyze a samtools file (.sam) and skip the format check.
         ## samReader.sh -i or --input <file> -v or --verbose # Launch samReader to analyze a samtools file (.sam) and print the result in the terminal with more information.
         ## samReader.sh -i or --input <file> -s or --single # Launch samReader to analyze a samtools file (.sam) and print the result in a single fasta file
+        ## samReader.sh -i or --input <file> -p or --threads <N> # Launch samReader to analyze a samtools file (.sam) with N processes
+        ## samReader.sh -i or --input <file> -r or --region <chr:start-end> # Launch samReader to analyze only the reads of a region of a samtools file (.sam)
+        ## samReader.sh -i or --input <file> -f or --format <json|tsv|npz> # Launch samReader to write the metrics of a samtools file (.sam) for other tools instead of the PDF report
+        ## samReader.sh -i or --input <file> -P or --profile # Launch samReader and print where the time of the run is spent
+        ## samReader.sh -b or --batch <manifest|"*.sam"> -p or --threads <N> # Launch samReader on every file of a cohort with N processes
   
 
 
 ############### IMPORT MODULES ###############
 
-import os, sys, getopt, yaml, importlib.util
-from tqdm.auto import tqdm
-import numpy as np
+import os, sys, getopt, glob, importlib.util
+from functools import cache
 import shutil
+import numpy as np
 
-from plotit import plot_depth_mapq, plot_mapping_ratio
-from common_functions import toBinary
+from coverage import writePyramid, denseTrack, coveredSpan
+from common_functions import (newRecordStore, appendRecord, storeSize, toBatch, takeBatch, concatBatches, textList,
+                              loadConfig)
+from readers import readBam, readCompressedLines, scanSam, readHeader, sortedByName, referenceLengths
+from indexer import scanRegion
+from cache import cacheDirectory, cacheKey, loadResults, storeResults, newEntry, addChromosome, closeEntry, dropEntry
+from export import FORMATS, binnedTracks, writeCohort, writeMetrics
+from profiler import profile, stage, count, timedIterator, profiledRun, enableProfiling, snapshot, mergeProfile
+
+# Accepted extensions of the input file
+COMPRESSED_SAM = (".sam.gz", ".sam.bgz")
+EXTENSIONS = (*COMPRESSED_SAM, ".sam", ".bam")
+# Tasks of a batch queued in the pool of processes for each of them, the next samples being read while one is reported
+IN_FLIGHT = 2
 
 ## 0/ Get options,
 def getOptions(argv):
@@ -53,7 +77,9 @@ def getOptions(argv):
     Get the parsed options, supporting both short and long forms
     """
     try:
-        opts, args = getopt.getopt(argv, "hi:o:tva", ["help", "input=", "output=", "trusted", "verbose", "ask-to-open"])
+        opts, args = getopt.getopt(argv, "hi:o:tvap:r:f:Pb:", ["help", "input=", "output=", "trusted", "verbose",
+                                                               "ask-to-open", "threads=", "region=", "format=",
+                                                               "profile", "profile-output=", "pstats=", "batch="])
     except getopt.GetoptError:
         os.system("samReader.sh -h")
         sys.exit(2)
@@ -63,6 +89,11 @@ def getOptions(argv):
     trusted = False
     verbose = False
     autoopen = False  # New flag to ask if the user wants to open the PDF file
+    threads = 1
+    region = None
+    output_format = "pdf"
+    batch = None
+    profiling = {"enabled": False, "output": None, "pstats": None}
     for opt, arg in opts:
         if opt in ("-i", "--input"):
             inputfile = arg
@@ -74,122 +105,847 @@ def getOptions(argv):
             verbose = True
         elif opt in ("-a", "--ask-to-open"):
             autoopen = True
-    return inputfile, outputfile, trusted, verbose, autoopen
+        elif opt in ("-p", "--threads"):
+            threads = max(int(arg), 1)
+        elif opt in ("-r", "--region"):
+            region = parseRegion(arg)
+        elif opt in ("-f", "--format"):
+            output_format = arg.lower()
+            if output_format not in ("pdf", *FORMATS):
+                print(f"The format {arg} is not supported. Please choose pdf, {', '.join(FORMATS)}.")
+                sys.exit(2)
+        elif opt in ("-P", "--profile"):
+            profiling["enabled"] = True
+        elif opt == "--profile-output":
+            profiling["output"] = arg
+        elif opt == "--pstats":
+            profiling["pstats"] = arg
+        elif opt in ("-b", "--batch"):
+            batch = arg
+    return inputfile, outputfile, trusted, verbose, autoopen, threads, region, output_format, batch, profiling
+
+## Parse a region
+def parseRegion(region):
+    """
+        Split a region chr:start-end (1-based, both ends included) in its chromosome, start and end
+        chr alone is the whole chromosome, with its unplaced reads (POS 0), and chr:start goes to its end
+    """
+    chromosome, colon, interval = region.rpartition(":")
+    if not colon: return region, 0, np.iinfo(np.int64).max
+
+    start, dash, end = interval.replace(",", "").partition("-")
+    if not start.isdigit() or (dash and not end.isdigit()) or (end and int(end) < int(start)):
+        print(f"The region {region} is not in the chr:start-end format.")
+        sys.exit(2)
+    return chromosome, max(int(start), 1), int(end) if end else np.iinfo(np.int64).max
 
 
-## Check, Read and store the data
-def checkFormat(file, check_line, trusted=False, verbose=False, separator='-', maq_threshold=0):
+## Import the modules of a version of SAM
+@cache
+def loadModules(version):
     """
-        Check the format of the input file
+        Import the analyse, checks and summarize modules of the selected version of SAM
+        They are imported once per process, the worker processes reuse them for every range
     """
-    if file.endswith(".sam"):
-        with open(file, "r") as f:
-            sam_line = f.readlines()
+    local_directory = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
+    modules = {"analyse": None,
+               "checks": None,
+               "summarize": None}
 
-        formated = {}
-        maxpos = {}
-        total_lines = {}
-        # Checks that every column follows the right formating
-        desc = "Checking the format of the input file and storing the data" if not trusted else "Storing the data"
-        iterator = tqdm(enumerate(sam_line), desc=desc, total=len(sam_line)) if verbose else enumerate(sam_line)
+    for module in modules:
+        file_path = os.path.join(local_directory, "SAM_specs", version, f"{module}.py")  # Define the path to the module
+        spec = importlib.util.spec_from_file_location(module, file_path)  # Create the spec
+        modules[module] = importlib.util.module_from_spec(spec)  # Create the module
+        spec.loader.exec_module(modules[module])  # Execute the module
+    return modules
+
+
+## Progress bars
+def progress(iterable, **kwargs):
+    """
+        Show the progress of an iterable, tqdm being only imported in verbose mode
+    """
+    from tqdm.auto import tqdm
+    return tqdm(iterable, **kwargs)
+
+
+## Stream the records of the input file
+def readSam(file, start=0, end=None, threads=1):
+    """
+        Yield the records of the input file one at a time, without loading the whole file in memory
+        Each record is the list of its columns followed by its line number
+        If start is given, the reading begins at this byte offset (which has to be the start of a line) and the line
+        numbers are counted from there. It stops at the first line starting at or after the byte offset end.
+        Compressed files (.sam.gz or .sam.bgz) are inflated while they are read, with threads for bgzip files
+    """
+    if file.endswith(COMPRESSED_SAM):
+        for n, line in enumerate(readCompressedLines(file, threads)):
+            if line.startswith(b'@') or not line: continue
+            line = line.decode().rstrip('\r').split('\t')
+            line.append(n + 1)  # Keep the line number to locate the errors
+            yield line
+        return
+
+    with open(file, "rb") as f:
+        f.seek(start)
+        offset = start
+        for n, line in enumerate(f):
+            if end is not None and offset >= end: break
+            offset += len(line)
+            if line.startswith(b'@'): continue
+            line = line.decode().rstrip('\r\n').split('\t')
+            line.append(n + 1 if start == 0 else f"{n + 1} after byte {start}")  # Keep the line number to locate the errors
+            yield line
+
+## Split the body of the input file in byte ranges
+def splitRanges(file, n_ranges):
+    """
+        Split the records of the input file in at most n_ranges byte ranges of about the same size
+        Every range starts at the beginning of a line, and the lines of the same QNAME are kept in the same range
+        so that the mates are analysed together
+    """
+    size = os.path.getsize(file)
+    with open(file, "rb") as f:
+        body = 0  # Skip the header
+        for line in f:
+            if not line.startswith(b'@'): break
+            body += len(line)
+
+        bounds = [body]
+        for k in range(1, n_ranges):
+            f.seek(body + (size - body) * k // n_ranges)
+            f.readline()  # Finish the current line
+            previous = f.readline()
+            while True:  # Move on to the first line of another QNAME
+                position = f.tell()
+                line = f.readline()
+                if not line or line.split(b'\t', 1)[0] != previous.split(b'\t', 1)[0]: break
+                previous = line
+            if bounds[-1] < position < size: bounds.append(position)
+        bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+## Report the chromosomes of a grouped input file as they are read
+def newGrouping(complete):
+    """
+        State of the streaming of the chromosomes of an input file grouped by chromosome
+        complete(qname, accumulator, lines) is called on each chromosome as soon as its run of records ends, and
+        returns what is kept of its accumulator. The runs are followed record by record (see followsRuns): when
+        a chromosome comes back after its run, the input file is not grouped, "grouped" turns False and the reading
+        stops before any chromosome read meanwhile is completed
+    """
+    return {"complete": complete,
+            "open": {},  # Chromosomes whose run of records has not ended, in their order
+            "completed": set(),
+            "grouped": True}
+
+def followsRuns(grouping, runs):
+    """
+        Whether the runs of records of a batch or of a byte range (their chromosomes, in their order) go on with
+        those already read: only the first one may go on with an open chromosome, and none comes back after its run
+    """
+    ended = set()
+    for n, qname in enumerate(runs):
+        if qname in grouping["completed"] or qname in ended or (n > 0 and qname in grouping["open"]): return False
+        ended.add(qname)
+    return True
+
+def endRuns(accumulators, total_lines, grouping, current=None, flush=None):
+    """
+        Complete every open chromosome but current, whose run of records has ended, once flush(qname) has analysed
+        its reads waiting in a buffer
+    """
+    for qname in [qname for qname in grouping["open"] if qname != current]:
+        del grouping["open"][qname]
+        if flush is not None: flush(qname)
+        grouping["completed"].add(qname)
+        accumulators[qname] = grouping["complete"](qname, accumulators[qname], total_lines[qname])
 
-        for n, line in iterator:
-            if line.startswith('@'): continue
-            line = line.split('\t')
-            qname = line[0].split(separator)[0]
-            line[1] = toBinary(line[1], 16)
+def streamInput(file, streaming="auto"):
+    """
+        Whether the chromosomes of the input file are reported as soon as their records end (see newGrouping):
+        always with streaming true, with auto when its header declares it sorted by QNAME, the only order grouping
+        the records by chromosome
+    """
+    if streaming == "auto": return sortedByName(readHeader(file))
+    return bool(streaming)
 
+## Check, Read and accumulate the data
+def ingest(records, check_line, analyse, results_dir, trusted=False, separator='-', maq_threshold=0, chunk_size=100000,
+           mapq_classes=0, fasta=None, grouping=None, references=None):
+    """
+        Check the format of the records and accumulate them chromosome by chromosome, in a single pass
+        Only a chunk of reads per chromosome is held in memory at once
+        The tracks of the chromosomes named as a reference of the header are allocated at its length
+        With a grouping (see newGrouping), each chromosome is completed as soon as its run of records ends
+    """
+    accumulators = {}
+    chunks = {}
+    total_lines = {}
+    current = None  # Chromosome of the run of records being read
+
+    def flush(qname):
+        if storeSize(chunks[qname]): analyse.accumulate(accumulators[qname], toBatch(chunks[qname]))
+        chunks[qname] = newRecordStore()
+
+    # Checks that every column follows the right formating
+    for line in timedIterator("read", records):
+        qname = line[0].split(separator)[0]
+        if grouping is not None and qname != current:
+            if qname in grouping["completed"]:
+                grouping["grouped"] = False
+                break
+            endRuns(accumulators, total_lines, grouping, qname, flush)
+            current = qname
+
+        if qname not in total_lines: total_lines[qname] = 0  # Create the key if it does not exist
+        total_lines[qname] += 1
+
+        check_line(line, trusted=trusted)
+        line[1] = int(line[1])
+
+        if int(line[4]) >= maq_threshold:
+            # Those lines buffer the reads of each chromosome in columns until a full chunk can be analysed
+            if qname not in accumulators:  # Create the keys if they do not exist
+                accumulators[qname] = analyse.newAccumulator(os.path.join(results_dir, qname), mapq_classes, fasta,
+                                                             (references or {}).get(qname, 0))
+                chunks[qname] = newRecordStore()
+                if grouping is not None: grouping["open"][qname] = None
+            appendRecord(chunks[qname], line)
+            if storeSize(chunks[qname]) >= chunk_size: flush(qname)
+
+    if grouping is None or grouping["grouped"]:
+        # Analyse what is left in the buffers
+        for qname in chunks: flush(qname)
+        if grouping is not None: endRuns(accumulators, total_lines, grouping)
+    analyse.closeFasta()  # Wait for the FASTA files to be written
+
+    return accumulators, total_lines
+
+def accumulateBatches(batches, analyse, results_dir, separator='-', maq_threshold=0, chunk_size=100000,
+                      mapq_classes=0, fasta=None, grouping=None, references=None):
+    """
+        Accumulate batches of records (see common_functions.toBatch) chromosome by chromosome
+        Each batch is split by chromosome, keeping the order of the reads, and the reads of a chromosome wait
+        until a full chunk can be analysed
+        The tracks of the chromosomes named as a reference of the header are allocated at its length
+        With a grouping (see newGrouping), each chromosome is completed as soon as its run of records ends
+    """
+    accumulators = {}
+    pending = {}  # Reads of each chromosome waiting for a full chunk
+    total_lines = {}
+
+    def flush(qname):
+        if pending[qname]: analyse.accumulate(accumulators[qname], concatBatches(pending[qname]))
+        pending[qname] = []
+
+    for batch in timedIterator("read", batches, size=lambda batch: batch["size"]):
+        # Group the reads of the batch by chromosome, keeping their order
+        keys = {}
+        codes = np.array([keys.setdefault(name.split(separator)[0], len(keys)) for name in textList(batch, "qname")],
+                         dtype=np.int64)
+        names = list(keys)
+        if grouping is not None and len(codes):  # The chromosome of the first record of each run, in their order
+            runs = codes[np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))]
+            if not followsRuns(grouping, [names[code] for code in runs]):  # A chromosome comes back
+                grouping["grouped"] = False
+                break
+        groups = np.split(np.argsort(codes, kind="stable"), np.cumsum(np.bincount(codes, minlength=len(keys)))[:-1])
+
+        for qname, selected in zip(keys, groups):
             if qname not in total_lines: total_lines[qname] = 0  # Create the key if it does not exist
-            total_lines[qname] += 1
+            total_lines[qname] += len(selected)
 
-            check_line(line, trusted=trusted)
+            selected = selected[batch["mapq"][selected] >= maq_threshold]
+            if len(selected) == 0: continue
+            if qname not in accumulators:  # Create the keys if they do not exist
+                accumulators[qname] = analyse.newAccumulator(os.path.join(results_dir, qname), mapq_classes, fasta,
+                                                             (references or {}).get(qname, 0))
+                pending[qname] = []
+                if grouping is not None: grouping["open"][qname] = None
+            pending[qname].append(takeBatch(batch, selected))
 
-            if int(line[4]) >= maq_threshold:
-                # Those two lines allow storing the data for each read that can be found in the sam file
-                if qname not in formated: formated[qname] = []  # Create the key if it does not exist
-                if qname not in maxpos: maxpos[qname] = (0, )  # Create the key if it does not exist
-                formated[qname].append(line[:11])  # Reduces the size of the data to store
-                if int(line[3]) > maxpos[qname][0] and line[5] != '*':
-                    maxpos[qname] = (int(line[3]), line[5])
+            if sum(chunk["size"] for chunk in pending[qname]) >= chunk_size:  # The mates are paired across chunks
+                flush(qname)
 
-        return formated, maxpos, total_lines
+        if grouping is not None and len(codes):  # Every chromosome but the one of the last read has ended
+            endRuns(accumulators, total_lines, grouping, names[codes[-1]], flush)
 
-    else:
-        print("The input file is not in the correct format. Please provide a .sam file.")
-        sys.exit(2)
+    if grouping is None or grouping["grouped"]:
+        # Analyse what is left in the buffers
+        for qname in pending: flush(qname)
+        if grouping is not None: endRuns(accumulators, total_lines, grouping)
+    analyse.closeFasta()  # Wait for the FASTA files to be written
 
-#### Main function ####
+    return accumulators, total_lines
 
-def main(argv):
+def scanRecords(file, checks, start=0, end=None, trusted=False, with_seq=True):
     """
-        Main function
+        Scan the records of an uncompressed SAM file mapped in memory, checking them block by block
+        A faulty line is reported as by check_line
+        SEQ is only decoded with_seq, when the reads are written in FASTA files
     """
-    inputfile, outputfile, trusted, verbose, autoopen = getOptions(argv)
+    try:
+        yield from scanSam(file, start, end, with_seq=with_seq, check_block=None if trusted else checks.check_block)
+    except ValueError as error:  # A line without its 11 mandatory columns
+        print(error)
+        sys.exit(2)
 
-    # Create a folder to store the output files
-    if outputfile == "": outputfile = os.path.basename(inputfile)[:-4]
+def ingestBam(file, analyse, results_dir, verbose=False, threads=1, **settings):
+    """
+        Accumulate the reads of a BAM file chromosome by chromosome
+        The records are decoded by batches from their binary encoding, which is already typed, so they are not checked
+        The BGZF blocks are inflated by as many threads as requested
+    """
+    records = readBam(file, analyse.SPECS['CIGAR_operations'], threads, with_seq=settings["fasta"] is not None)
+    next(records)  # Skip the header
+    if verbose: records = progress(records, desc="Decoding and analysing the BAM file", unit=" batches")
+    return accumulateBatches(records, analyse, results_dir, **settings)
 
-    results_dir = os.path.join(os.getcwd(), f"{outputfile}_results")  # Create the results directory
+def checkRange(file, start, end, part_dir, version, trusted=False, profiling=False, grouped=False, **settings):
+    """
+        Check and accumulate the records of a byte range of the input file, in a worker process
+        The accumulators are compacted to be sent back to the main process
+        With profiling, the records of the stages of the range are sent back too, to be merged in the main process
+        With grouped, the runs of records of the range are followed (see followsRuns) and None is sent back as soon
+        as a chromosome comes back after its run
+    """
+    if profiling: enableProfiling()
+    modules = loadModules(version)
+    records = scanRecords(file, modules['checks'], start, end, trusted, with_seq=settings["fasta"] is not None)
+    # The chromosomes of the range are only completed by the main process, with those of the other ranges
+    grouping = newGrouping(lambda qname, accumulator, lines: accumulator) if grouped else None
+    accumulators, total_lines = accumulateBatches(records, modules['analyse'], part_dir, grouping=grouping, **settings)
+    if grouping is not None and not grouping["grouped"]: return None
+    return compactResults(modules['analyse'], accumulators, total_lines, profiling)
+
+def checkFile(file, part_dir, version, trusted=False, profiling=False, **settings):
+    """
+        Check and accumulate the records of a whole input file (BAM, compressed SAM or a region) in a worker process,
+        as checkRange does for a byte range
+    """
+    if profiling: enableProfiling()
+    modules = loadModules(version)
+    accumulators, total_lines = checkFormat(file, modules['checks'], modules['analyse'], part_dir, trusted=trusted,
+                                            version=version, **settings)
+    return compactResults(modules['analyse'], accumulators, total_lines, profiling)
 
-    local_directory = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
+def compactResults(analyse, accumulators, total_lines, profiling=False):
+    """
+        Compact the accumulators of a worker process to send them back, with the records of its stages if profiled
+    """
+    with stage("compactAccumulator"):
+        compacted = {qname: analyse.compactAccumulator(accumulator) for qname, accumulator in accumulators.items()}
+    return compacted, total_lines, snapshot() if profiling else None
 
-    os.makedirs(results_dir, exist_ok=True)  # Create the directory if it doesn't exist
-    os.makedirs(os.path.join(os.getcwd(), "temp"), exist_ok=True)
+def mergeResults(accumulators, total_lines, partial, analyse, results_dir, mapq_classes=0, fasta=None,
+                 references=None):
+    """
+        Merge the compacted accumulators sent back by a worker process (see compactResults) in the accumulators
+        and the number of reads of each chromosome of the file, the partial results being merged in the order of the file
+    """
+    partials, partial_lines, stages = partial
+    with stage("workers"):  # Time spent in every process, added up
+        mergeProfile(stages)
+    for qname, partial in partials.items():
+        if qname not in accumulators:  # Create the key if it does not exist
+            accumulators[qname] = analyse.newAccumulator(os.path.join(results_dir, qname), mapq_classes, fasta,
+                                                         (references or {}).get(qname, 0))
+        with stage("mergeAccumulators"):
+            analyse.mergeAccumulators(accumulators[qname], partial)
+    for qname, lines in partial_lines.items():
+        total_lines[qname] = total_lines.get(qname, 0) + lines
+
+def checkFormat(file, checks, analyse, results_dir, trusted=False, verbose=False, separator='-', maq_threshold=0,
+                chunk_size=100000, mapq_classes=0, threads=1, version=None, region=None, fasta=None, grouping=None,
+                references=None):
+    """
+        Check the format of the input file and accumulate its reads chromosome by chromosome
+        With more than one thread, byte ranges of the file are checked and accumulated in a pool of processes
+        and their partial accumulators are merged in the order of the file
+        BAM files are decoded from their binary records, their BGZF blocks being inflated by the threads
+        Compressed SAM files are streamed while they are inflated, by the threads for bgzip files
+        Uncompressed SAM files are mapped in memory and scanned block by block
+        With a region, only the byte ranges of the uncompressed SAM file holding its reads are read, through the index
+        stored next to the file (built on the first use)
+        SEQ is only decoded when the reads are written in FASTA files (see analyse.readMapping)
+        With a grouping (see newGrouping), each chromosome is completed as soon as its run of records ends, except
+        in a region which holds a single chromosome
+        references gives the length of the reference of each chromosome (see readers.referenceLengths)
+    """
+    settings = {"separator": separator, "maq_threshold": maq_threshold,
+                "chunk_size": chunk_size, "mapq_classes": mapq_classes, "fasta": fasta, "references": references}
+    desc = "Checking the format of the input file and analysing the data" if not trusted else "Analysing the data"
+
+    if region is not None:
+        if not file.endswith(".sam") or file.endswith(COMPRESSED_SAM):
+            print("A region can only be read from an uncompressed .sam file.")
+            sys.exit(2)
+        try:
+            records = scanRegion(file, analyse, region, separator, check_block=None if trusted else checks.check_block,
+                                 verbose=verbose, with_seq=fasta is not None)
+            return accumulateBatches(records, analyse, results_dir, **settings)
+        except ValueError as error:  # An unknown chromosome or a line without its 11 mandatory columns
+            print(error)
+            sys.exit(2)
+
+    elif file.endswith(".bam"):
+        return ingestBam(file, analyse, results_dir, verbose=verbose, threads=threads, grouping=grouping, **settings)
+
+    elif file.endswith(COMPRESSED_SAM):  # A compressed file cannot be split in byte ranges
+        records = readSam(file, threads=threads)
+        if verbose: records = progress(records, desc=desc, unit=" reads")
+        return ingest(records, checks.check_line, analyse, results_dir, trusted=trusted, grouping=grouping, **settings)
+
+    elif file.endswith(".sam"):
+        if threads == 1:
+            records = scanRecords(file, checks, trusted=trusted, with_seq=fasta is not None)
+            if verbose: records = progress(records, desc=desc, unit=" blocks")
+            return accumulateBatches(records, analyse, results_dir, grouping=grouping, **settings)
+
+        accumulators = {}
+        total_lines = {}
+        temp_dir = os.path.join(os.getcwd(), "temp")
+        ranges = splitRanges(file, threads * 4)  # More ranges than processes to balance the load
+
+        from concurrent.futures import ProcessPoolExecutor  # Only needed with several processes
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            futures = [pool.submit(checkRange, file, start, end, os.path.join(temp_dir, f"range_{k}"), version,
+                                   trusted=trusted, profiling=profile["enabled"], grouped=grouping is not None,
+                                   **settings)
+                       for k, (start, end) in enumerate(ranges)]
+            if verbose:
+                futures = progress(futures, desc=f"Analysing the data with {threads} processes", unit=" ranges")
+
+            for k, future in enumerate(futures):  # Merge in the order of the file
+                with stage("wait for the workers"):
+                    partial = future.result()
+                # The chromosomes of a grouped range are in the order of their runs
+                if grouping is not None and (partial is None or not followsRuns(grouping, list(partial[1]))):
+                    grouping["grouped"] = False  # A chromosome comes back, the other ranges are not needed
+                    pool.shutdown(cancel_futures=True)
+                    break
+                mergeResults(accumulators, total_lines, partial, analyse, results_dir, mapq_classes, fasta, references)
+                shutil.rmtree(os.path.join(temp_dir, f"range_{k}"), ignore_errors=True)
+                partial_lines = partial[1]
+                if grouping is not None and partial_lines:  # Every chromosome but the last one of the range has ended
+                    grouping["open"].update(dict.fromkeys(partial[0]))
+                    endRuns(accumulators, total_lines, grouping, list(partial_lines)[-1])
+
+        if grouping is not None:
+            if not grouping["grouped"]:
+                for k in range(len(ranges)): shutil.rmtree(os.path.join(temp_dir, f"range_{k}"), ignore_errors=True)
+            else: endRuns(accumulators, total_lines, grouping)
+        return accumulators, total_lines
 
-    config = yaml.safe_load(open(f"{local_directory}/config.yaml", "r")) # Load the version from the config file
-    modules = {"analyse": None,
-               "checks": None,
-               "summarize": None}
+    else:
+        print("The input file is not in the correct format. Please provide a .sam, .sam.gz or .bam file.")
+        sys.exit(2)
 
-    # We import the right modules for the selected version of SAM
-    for module in modules:
-        file_path = os.path.join(local_directory, "SAM_specs", config['version'] , f"{module}.py")  # Define the path to the module
-        spec = importlib.util.spec_from_file_location(module, file_path)  # Create the spec
-        modules[module] = importlib.util.module_from_spec(spec)  # Create the module
-        spec.loader.exec_module(modules[module])  # Execute the module
+## Results of a chromosome
+def chromosomeResults(accumulator, lines, maq_threshold=0):
+    """
+        Gather the mapping counts, the CIGAR and FLAG totals and the number of reads of a chromosome,
+        as they are summarized in its page
+    """
+    results = dict(accumulator["results"])
+    results.update(accumulator["cigar"])
+    results.update(accumulator["flags"])
+    results['total'] = lines
+    results['qual'] = maq_threshold
+    return results
 
-    # Check the format of the input file and store the data
-    formated, maxpos, total_lines = checkFormat(inputfile, trusted=trusted, verbose=verbose,
-                                                check_line=modules['checks'].check_line,
-                                                separator=config['separator'],
-                                                maq_threshold=config['mapq threshold'])
+#### Main function ####
 
-    total = None
-    for chromosome, reads in formated.items():  # Iterate over the reads
-        reads = np.array(reads)  # Convert the list to a numpy array
+def main(argv):
+    """
+        Main function
+    """
+    inputfile, outputfile, trusted, verbose, autoopen, threads, region, output_format, batch, profiling = getOptions(argv)
+    with profiledRun(**profiling):  # Nothing is recorded without --profile
+        if batch is not None:
+            runBatch(batch, outputfile, trusted, verbose, threads, region, output_format)
+        else:
+            run(inputfile, outputfile, trusted, verbose, autoopen, threads, region, output_format)
+
+def run(inputfile, outputfile, trusted=False, verbose=False, autoopen=False, threads=1, region=None,
+        output_format="pdf"):
+    """
+        Analyse the input file and write the report, or the metrics in another format
+    """
+    settings = loadSettings()
+    sample = newSample(inputfile, outputfile, settings, region, trusted)
 
-        length = maxpos[chromosome][0] + len(modules['analyse'].readCigar(maxpos[chromosome][1])[1])
-        mapq = np.zeros(length, dtype=np.int16)  # Create an array of zeros to store the mapq
-        depth = np.zeros(length, dtype=np.int16)  # Create an array of zeros to store the depth
+    if sample["cached"]:
+        if verbose: print("The analyses of the input file are reused from the cache")
+    else:
+        config = settings["config"]
+
+        def analyseInput(grouping=None):  # Check the format of the input file and analyse the data while it is read
+            with stage("checkFormat", nbytes=os.path.getsize(inputfile)):
+                sample["accumulators"], sample["total_lines"] = checkFormat(inputfile, trusted=trusted, verbose=verbose,
+                                                                            checks=settings["modules"]['checks'],
+                                                                            analyse=settings["modules"]['analyse'],
+                                                                            results_dir=sample["results_dir"],
+                                                                            threads=threads,
+                                                                            version=config['version'],
+                                                                            region=region,
+                                                                            grouping=grouping,
+                                                                            references=sample["references"],
+                                                                            **settings["analysis"])
+                count(records=sum(sample["total_lines"].values()))
+
+        grouping = entry = None
+        if region is None and streamInput(inputfile, config['streaming']):
+            # The chromosomes of a streamed file are stored in the cache one by one, before their tracks are released
+            entry = newEntry(settings["cache"], sample["key"]) if sample["key"] is not None else None
+
+            def complete(chromosome, accumulator, lines):  # Report a chromosome as soon as its records are read
+                reportChromosome(sample, settings, chromosome, accumulator, lines, region, output_format, verbose)
+                if entry is not None:
+                    with stage("cache store"):
+                        addChromosome(entry, chromosome, accumulator)
+                return {key: accumulator[key] for key in ("path", "results", "cigar", "flags")}  # Its tracks are released
+
+            grouping = newGrouping(complete)
+        analyseInput(grouping)
+        if grouping is not None and not grouping["grouped"]:
+            if verbose: print("The input file is not grouped by chromosome, it is read again to report them at the end")
+            sample["reported"], sample["exported"] = {}, {}
+            if entry is not None: dropEntry(entry)
+            entry = None
+            analyseInput()
+        storeSample(sample, settings, trusted, verbose, entry)
+
+    if reportSample(sample, settings, region, output_format, verbose, threads) is None:
+        print("No read to analyse.")
+        sys.exit(2)
 
-        results = modules["analyse"].readMapping(reads, os.path.join(results_dir, chromosome), verbose=verbose)
+    if output_format == "pdf":
+        shutil.rmtree(os.path.join(os.getcwd(), "temp"))  # remove the temp directory
+        if autoopen:
+            os.system(f"xdg-open \"{os.path.join(sample['results_dir'], sample['name'])}.pdf\"")
 
-        cigar, depth, mapq = modules["analyse"].globalPercentCigar(reads, depth, mapq, verbose=verbose)
+## Settings of the analyses
+def loadSettings():
+    """
+        Load the config file, the modules of its version of SAM and the settings of the analyses
+        They are loaded once, for every input file of a batch
+    """
+    config = loadConfig()  # Load the version from the config file, shared with the modules of the version
 
-        plot_depth_mapq(depth, mapq, bins=config['bins'],
-                        depth_median=config['calculation method']['depth'] == "median",
-                        mapq_median=config['calculation method']['mapq'] == "median",
-                        n_ticks=config['n ticks'])
+    # We import the right modules for the selected version of SAM
+    modules = loadModules(config['version'])
+
+    # The categories of reads written in FASTA files, none by default
+    fasta = None
+    if config['fasta export']:
+        unknown = set(config['fasta export']) - set(modules['analyse'].CATEGORIES)
+        if unknown:
+            print(f"Unknown FASTA export categories {sorted(unknown)}, "
+                  f"please choose among {modules['analyse'].CATEGORIES}.")
+            sys.exit(2)
+        fasta = {"categories": list(config['fasta export']), "compression": config['fasta compression']}
+
+    return {"config": config, "modules": modules, "fasta": fasta,
+            "cache": cacheDirectory(config),  # Analyses reused across runs (see cache.py)
+            "analysis": {"separator": config['separator'], "maq_threshold": config['mapq threshold'],
+                         "chunk_size": config['chunk size'], "mapq_classes": config['mapq histogram'], "fasta": fasta}}
+
+## Input files
+def sampleName(inputfile):
+    """
+        Name of the outputs of an input file: its name without its extension
+    """
+    name = os.path.basename(inputfile)
+    for extension in EXTENSIONS:  # Remove the extension of the input file
+        if name.endswith(extension): return name[:-len(extension)]
+    return name
 
-        for mutation, total_value in cigar.items():
-            results[mutation] = total_value
-        results['total'] = total_lines[chromosome]
-        results['qual'] = config['mapq threshold']
+def newSample(inputfile, outputfile, settings, region=None, trusted=False):
+    """
+        Create the results directory of an input file and look its analyses up in the cache
+        The accumulators of the sample are empty until it is analysed, unless they are reused from the cache
+    """
+    if outputfile == "": outputfile = sampleName(inputfile)
+    results_dir = os.path.join(os.getcwd(), f"{outputfile}_results")  # Create the results directory
+    os.makedirs(results_dir, exist_ok=True)  # Create the directory if it doesn't exist
 
-        modules["summarize"].summarize(chromosome, results, results_dir, verbose=verbose)
+    # The analyses of the same input file with the same settings are reused, only the plots and the reports are made
+    config, fasta = settings["config"], settings["fasta"]
+    key = None
+    if config['cache size'] > 0:
+        key = cacheKey(inputfile, {"version": config['version'], "separator": config['separator'],
+                                   "mapq threshold": config['mapq threshold'],
+                                   "mapq histogram": config['mapq histogram'], "region": region, "fasta": fasta,
+                                   # The FASTA files are only reused where they were written
+                                   "results": results_dir if fasta is not None else None})
+    with stage("cache lookup"):
+        cached = loadResults(settings["cache"], key, trusted) if key is not None else None
+
+    accumulators, total_lines = cached if cached is not None else ({}, {})
+    return {"input": inputfile, "name": outputfile, "results_dir": results_dir, "key": key,
+            "cached": cached is not None, "accumulators": accumulators, "total_lines": total_lines,
+            "references": referenceLengths(readHeader(inputfile)),  # Length of each reference (@SQ) of the header
+            "reported": {},  # Results of each chromosome reported, see reportChromosome
+            "exported": {}}  # Metrics and bins of each chromosome, for the other formats
+
+def storeSample(sample, settings, trusted=False, verbose=False, entry=None):
+    """
+        Store the analyses of a sample in the cache, if it is enabled
+        The chromosomes of a streamed sample are already in its entry (see cache.newEntry), which is only closed
+        The run goes on without storing them when the cache cannot be written
+    """
+    if sample["key"] is None: return
+    max_bytes = settings["config"]['cache size'] << 20
+    with stage("cache store"):
+        if entry is not None:
+            stored = closeEntry(entry, sample["total_lines"], not trusted, max_bytes)
+        else:
+            stored = storeResults(settings["cache"], sample["key"], sample["accumulators"], sample["total_lines"],
+                                  not trusted, max_bytes)
+    if not stored and verbose: print(f"The analyses could not be stored in the cache {settings['cache']}")
+
+## Report of a sample
+def reportSample(sample, settings, region=None, output_format="pdf", verbose=False, threads=1):
+    """
+        Write the report of an analysed sample, or its metrics in another format
+        The chromosomes already reported while the input file was read (see newGrouping) are not reported again
+        In the other formats, the references of the header without any read are reported too, with zero counts
+        Returns the metrics of its genome, None if it has no read
+    """
+    accumulators, total_lines = sample["accumulators"], sample["total_lines"]
+    if not accumulators: return None
+
+    modules = settings["modules"]
+    results_dir, outputfile = sample["results_dir"], sample["name"]
+    for chromosome, accumulator in accumulators.items():  # Iterate over the chromosomes
+        if chromosome not in sample["reported"]:
+            reportChromosome(sample, settings, chromosome, accumulator, total_lines[chromosome], region, output_format,
+                             verbose)
+    references = sample["references"]
+    if output_format != "pdf" and region is None and all(chromosome in references for chromosome in accumulators):
+        # The chromosomes are the references of the header: those without any read are reported with zero counts
+        for reference in references:
+            if reference not in sample["reported"]:
+                reportEmpty(sample, settings, reference, total_lines.get(reference, 0))
 
-        if total is None: total = results
+    total = None
+    for results in sample["reported"].values():
+        if total is None: total = dict(results)
         else: total = {chromosome: total[chromosome] + results[chromosome] for chromosome in total}
+    genome = modules["summarize"].metrics(total)
+
+    if output_format != "pdf":
+        with stage("writeMetrics"):
+            files = writeMetrics(results_dir, outputfile, output_format, genome, sample["exported"])
+        for file in files:
+            if verbose: print(f"The metrics are written in {file}")
+        return genome
+
+    from plotit import plot_mapping_ratio
+    with stage("plot_mapping_ratio"):
+        plot_mapping_ratio(sample["reported"])
+    total['chromosomes'] = sample["reported"].keys()
+    # Render the pages of the report, several at once
+    with stage("report", records=len(sample["reported"]) + 1):
+        modules["summarize"].summarize(outputfile, total, results_dir, verbose=verbose, genome=True,
+                                       workers=threads if threads > 1 else os.cpu_count() or 1)
+    return genome
+
+def reportChromosome(sample, settings, chromosome, accumulator, lines, region=None, output_format="pdf",
+                     verbose=False):
+    """
+        Plot the depth and the MAPQ of a chromosome once all its reads are accumulated and write its page,
+        or keep its metrics and bins for the other formats
+        Its results are kept in the sample for the page of the genome
+    """
+    config, modules = settings["config"], settings["modules"]
+    results_dir = sample["results_dir"]
+    report = output_format == "pdf"  # The other formats only hold the metrics, without LaTeX nor plots
+    if report:
+        os.makedirs(os.path.join(os.getcwd(), "temp"), exist_ok=True)
+        from plotit import plot_depth_mapq  # matplotlib is only needed for the report
+
+    with stage("finalizeAccumulator", records=lines):
+        depth, mapq = modules["analyse"].finalizeAccumulator(accumulator)
+    # Only plot the positions of the region
+    start, end = (region[1], min(region[2] + 1, depth["length"])) if region is not None else (0, depth["length"])
+    if config['coverage pyramid']:  # Depth and MAPQ at several resolutions, for the downstream tools
+        tracks = {"depth": denseTrack(depth, 0, end), "mapq": denseTrack(mapq, 0, end)}
+        for values in tracks.values(): values[:start] = 0
+        with stage("writePyramid", nbytes=sum(values.nbytes for values in tracks.values())):
+            writePyramid(os.path.join(results_dir, f"{chromosome}_coverage.npz"), tracks)
+        del tracks
+    # The plots leave out the positions before the first and after the last covered one, only they are read
+    first, last = coveredSpan([depth, mapq], start, end)
+    depth, mapq = denseTrack(depth, first, last), denseTrack(mapq, first, last)
+
+    depth_median = config['calculation method']['depth'] == "median"
+    mapq_median = config['calculation method']['mapq'] == "median"
+    # One image per chromosome, the pages are rendered at the end
+    image = f"temp/chromosome_{len(sample['reported'])}.png"
+    if report:
+        with stage("plot_depth_mapq", records=len(depth)):
+            plot_depth_mapq(depth, mapq, bins=config['bins'], depth_median=depth_median, mapq_median=mapq_median,
+                            n_ticks=config['n ticks'], path=image, offset=first)
+    else:
+        with stage("binnedTracks", records=len(depth)):
+            bins = binnedTracks(depth, mapq, bins=config['bins'], depth_median=depth_median, mapq_median=mapq_median,
+                                offset=first)
+
+    results = chromosomeResults(accumulator, lines, config['mapq threshold'])
+    if report:
+        with stage("summarize"):
+            modules["summarize"].summarize(chromosome, results, results_dir, verbose=verbose, image=image)
+    else:
+        sample["exported"][chromosome] = (modules["summarize"].metrics(results), bins)
+    sample["reported"][chromosome] = results
 
-    plot_mapping_ratio(results_dir)
-    total['chromosomes'] = formated.keys()
-    modules["summarize"].summarize(outputfile, total, results_dir, verbose=verbose, genome=True)
+def reportEmpty(sample, settings, chromosome, lines=0):
+    """
+        Keep the zero counts and the empty bins of a reference of the header without any read, in the formats other
+        than the PDF report, without writing anything for it
+    """
+    config, modules = settings["config"], settings["modules"]
+    nothing = np.zeros(0)
+    results = chromosomeResults(modules["analyse"].emptyCounts(), lines, config['mapq threshold'])
+    sample["exported"][chromosome] = (modules["summarize"].metrics(results),
+                                      binnedTracks(nothing, nothing, bins=config['bins']))
+    sample["reported"][chromosome] = results
+
+#### Batch mode ####
+
+def batchInputs(batch):
+    """
+        Input files of a batch with the name of their outputs: the lines of a manifest (the path of a file per line,
+        optionally followed by a tab and the name of its outputs, the relative paths starting from the manifest
+        and # starting a comment), or the files matching a glob pattern, in their order
+    """
+    inputs = []
+    if os.path.isfile(batch) and not batch.endswith(EXTENSIONS):
+        directory = os.path.dirname(os.path.abspath(batch))
+        with open(batch) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line: continue
+                path, _, name = line.partition('\t')
+                inputs.append((os.path.join(directory, path.strip()), name.strip()))
+    else:
+        inputs = [(path, "") for path in sorted(glob.glob(batch))]
 
-    # remove the temp directory
-    shutil.rmtree(os.path.join(os.getcwd(), "temp"))
+    if not inputs:
+        print(f"No input file found in {batch}.")
+        sys.exit(2)
+    for path, _ in inputs:
+        if not os.path.isfile(path):
+            print(f"The input file {path} does not exist. Please provide the correct path.")
+            sys.exit(2)
+    names = [name or sampleName(path) for path, name in inputs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:  # Their results directories would be the same
+        print(f"Several input files have the same name {duplicates}, please name them in the manifest.")
+        sys.exit(2)
+    return list(zip([path for path, _ in inputs], names))
 
-    if autoopen:
-        os.system(f"xdg-open \"{os.path.join(results_dir, outputfile)}.pdf\"")
+def batchTasks(inputs, settings, threads=1, region=None, trusted=False):
+    """
+        Yield the tasks of the pool of processes for the input files of a batch, in their order
+        Each task holds its sample, whether it is the last one of the sample, and the function run by the pool with
+        its arguments and the directory of its partial FASTA files
+        The uncompressed SAM files are split in byte ranges (see checkRange) and the other files are a single task
+        (see checkFile). A sample reused from the cache has a single task without function
+        The samples are only created when their tasks are queued, so that the cached ones are loaded one at a time
+    """
+    version = settings["config"]['version']
+    temp_dir = os.path.join(os.getcwd(), "temp")
+    for i, (path, name) in enumerate(inputs):
+        sample = newSample(path, name, settings, region, trusted)
+        if sample["cached"]:
+            yield {"sample": sample, "last": True, "function": None}
+        elif path.endswith(".sam") and region is None:
+            ranges = splitRanges(path, threads * 4)
+            for k, (start, end) in enumerate(ranges):
+                part_dir = os.path.join(temp_dir, f"sample_{i}_range_{k}")
+                yield {"sample": sample, "last": k == len(ranges) - 1, "function": checkRange, "part_dir": part_dir,
+                       "arguments": (path, start, end, part_dir, version), "keywords": {}}
+        else:
+            part_dir = os.path.join(temp_dir, f"sample_{i}")
+            yield {"sample": sample, "last": True, "function": checkFile, "part_dir": part_dir,
+                   "arguments": (path, part_dir, version), "keywords": {"region": region}}
+
+def runBatch(batch, cohort="", trusted=False, verbose=False, threads=1, region=None, output_format="pdf"):
+    """
+        Analyse every input file of a batch (see batchInputs) in this process, the settings and the modules being
+        loaded once, with a single pool of threads processes for all of them
+        Their tasks (see batchTasks) are queued in the pool in the order of the batch, at most IN_FLIGHT per process,
+        so that the next samples are read while one is reported and only a few samples are held in memory
+        Each sample has its usual results directory, and the metrics of the genome of every sample are written
+        in the cohort table <cohort>.tsv (cohort.tsv by default). A faulty input file is left out of the table,
+        the other ones being analysed, and the batch then ends with an error
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    settings = loadSettings()
+    analyse = settings["modules"]['analyse']
+    inputs = batchInputs(batch)
+    samples = {}  # Input file and metrics of the genome of each sample reported
+    failed = []
+
+    def finish(sample):
+        if sample.get("failed"):  # Its error was printed by its checks
+            print(f"The analysis of {sample['input']} failed, it is left out of the cohort.")
+            failed.append(sample["input"])
+            return
+        if not sample["cached"]: storeSample(sample, settings, trusted, verbose)
+        genome = reportSample(sample, settings, region, output_format, verbose, threads)
+        if genome is None:
+            print(f"No read to analyse in {sample['input']}.")
+            return
+        samples[sample["name"]] = (sample["input"], genome)
+        if verbose: print(f"{sample['input']} is analysed ({len(samples)}/{len(inputs)})")
+
+    tasks = batchTasks(inputs, settings, threads, region, trusted)
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        def fill():  # Queue the next tasks, so that the processes are never idle
+            while len(in_flight) < threads * IN_FLIGHT:
+                task = next(tasks, None)
+                if task is None: return
+                if task["function"] is not None:
+                    task["future"] = pool.submit(task["function"], *task["arguments"], trusted=trusted,
+                                                 profiling=profile["enabled"], references=task["sample"]["references"],
+                                                 **task["keywords"], **settings["analysis"])
+                in_flight.append(task)
+
+        fill()
+        while in_flight:
+            task = in_flight.popleft()
+            fill()
+            sample = task["sample"]
+            if task["function"] is not None:
+                try:
+                    with stage("wait for the workers"):
+                        partial = task["future"].result()
+                    if not sample.get("failed"):
+                        mergeResults(sample["accumulators"], sample["total_lines"], partial, analyse,
+                                     sample["results_dir"], settings["config"]['mapq histogram'], settings["fasta"],
+                                     sample["references"])
+                except SystemExit:  # A faulty input file, the other ones are still analysed
+                    sample["failed"] = True
+                shutil.rmtree(task["part_dir"], ignore_errors=True)
+            if task["last"]: finish(sample)
+
+    shutil.rmtree(os.path.join(os.getcwd(), "temp"), ignore_errors=True)
+    if not samples:
+        print("No read to analyse.")
+        sys.exit(2)
+    file = os.path.join(os.getcwd(), f"{cohort or 'cohort'}.tsv")
+    writeCohort(file, samples)
+    print(f"The metrics of the {len(samples)} samples are written in {file}")
+    if failed: sys.exit(2)
 
 ############### LAUNCH THE SCRIPT ###############
 
@@ -2,21 +2,27 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os, shutil
 
+from coverage import summarizeTrack
+
 def plot_depth_mapq(depth: np.array,
-                    mapq:list[(int, int)],
+                    mapq: np.array,
                     bins=100,
                     depth_median=True,
                     mapq_median=True,
-                    n_ticks=10):
+                    n_ticks=10,
+                    path="temp/chromosome.png",
+                    offset=0):
     """
     Plot the depth and mapq of the reads.
 
     Args:
-        :param mapq: A list of tuples containing the position and the MAPQ score.
+        :param mapq: A numpy array containing the MAPQ of each position (mean or median of the reads covering it).
         :param depth: A numpy array containing the depth of the reads.
         :param mapq_median: A boolean indicating whether to use the median of the MAPQ scores.
         :param depth_median: A boolean indicating whether to use the median of the depth.
         :param bins: The number of bins to divide the data into.
+        :param path: The file where the plot is saved.
+        :param offset: The position of the first value of the arrays, when they only hold a span of the chromosome.
     """
 
     # Remove the zeros at the beginning and the end of the arrays
@@ -31,31 +37,9 @@ def plot_depth_mapq(depth: np.array,
     min_index = min(depth_start_index, mapq_start_index)
     max_index = max(depth_end_index, mapq_end_index)
 
-    # Divide the depth into bins
-    ls_depth = np.linspace(0, len(depth), bins + 1, dtype=np.int64)
-    ls_mapq = np.linspace(0, len(mapq), bins + 1, dtype=np.int64)
-
-    classed_depth = [depth[ls_depth[i]:ls_depth[i + 1]] for i in range(bins)]  # Divide the depth into classes
-    classed_mapq = [mapq[ls_mapq[i]:ls_mapq[i + 1]] for i in range(bins)]
-
-    # I know this is not pretty, but at least it's clear what's happening
-    if depth_median:
-        sampled_depth = np.array([np.median(cd) if len(cd) > 0 else np.nan for cd in classed_depth])
-        depth_lower_limit = np.array([np.percentile(cd, 25) if len(cd) > 0 else np.nan  for cd in classed_depth])
-        depth_upper_limit = np.array([np.percentile(cd, 75) if len(cd) > 0 else np.nan  for cd in classed_depth])
-    else:
-        sampled_depth = np.array([np.mean(cd) if len(cd) > 0 else np.nan for cd in classed_depth])
-        depth_lower_limit = np.array([sampled_depth[n]-np.std(cd) if len(cd) > 0 else np.nan for n, cd in enumerate(classed_depth)])
-        depth_upper_limit = np.array([sampled_depth[n]+np.std(cd) if len(cd) > 0 else np.nan for n, cd in enumerate(classed_depth)])
-
-    if mapq_median:
-        sampled_mapq = np.array([np.median(cm) if len(cm) > 0 else np.nan for cm in classed_mapq])
-        mapq_lower_limit = np.array([np.percentile(cm, 25) if len(cm) > 0 else np.nan for cm in classed_mapq])
-        mapq_upper_limit = np.array([np.percentile(cm, 75) if len(cm) > 0 else np.nan for cm in classed_mapq])
-    else:
-        sampled_mapq = np.array([np.mean(cm) if len(cm) > 0 else np.nan for cm in classed_mapq])
-        mapq_lower_limit = np.array([sampled_mapq[n]-np.std(cm) if len(cm) > 0 else np.nan for n, cm in enumerate(classed_mapq)])
-        mapq_upper_limit = np.array([sampled_mapq[n]+np.std(cm) if len(cm) > 0 else np.nan for n, cm in enumerate(classed_mapq)])
+    # Summarize the depth and the mapq in bins, all the bins at once
+    sampled_depth, depth_lower_limit, depth_upper_limit = summarizeTrack(depth, bins, median=depth_median)
+    sampled_mapq, mapq_lower_limit, mapq_upper_limit = summarizeTrack(mapq, bins, median=mapq_median)
     # The interpolation doesn't happen all the time, only when some values are missing
     # It's the limitation of this graph, it cannot be precise base-per-base without being confusing and so it has to be interpolated
 
@@ -65,7 +49,7 @@ def plot_depth_mapq(depth: np.array,
 
     # Plot the depth
     ax1.plot(sampled_depth, label='Mean depth', color='tab:blue')
-    ax1.fill_between(np.arange(0, len(classed_depth)), depth_lower_limit, depth_upper_limit, alpha=0.3, label='Interquartile range', color='tab:blue')
+    ax1.fill_between(np.arange(0, bins), depth_lower_limit, depth_upper_limit, alpha=0.3, label='Interquartile range', color='tab:blue')
 
     # Set the labels and limits
     ax1.set_xlim(0, bins-1)
@@ -77,7 +61,7 @@ def plot_depth_mapq(depth: np.array,
 
     # Plot the mapq
     ax2.plot(sampled_mapq, color='tab:orange', label='Mapping Quality (MAPQ)')
-    ax2.fill_between(np.arange(0, len(classed_mapq)), mapq_lower_limit, mapq_upper_limit, alpha=0.3, color='tab:orange')
+    ax2.fill_between(np.arange(0, bins), mapq_lower_limit, mapq_upper_limit, alpha=0.3, color='tab:orange')
     ax2.set_ylabel('Mapping Quality (MAPQ)', color='tab:orange')
     ax2.spines['right'].set_color('tab:orange')
 
@@ -87,8 +71,8 @@ def plot_depth_mapq(depth: np.array,
     ax2.tick_params(colors='tab:orange', axis='y')
 
     # Adjust x-ticks to reflect original positions
-    ticks = np.linspace(0, len(classed_depth) - 1, n_ticks, dtype=int)
-    tick_labels = np.linspace(min_index, max_index, n_ticks, dtype=int)  # Match to original positions
+    ticks = np.linspace(0, bins - 1, n_ticks, dtype=int)
+    tick_labels = np.linspace(min_index + offset, max_index + offset, n_ticks, dtype=int)  # Match to original positions
 
     ax1.set_xticks(ticks)
     ax1.set_xticklabels([format_size(tick_label) for tick_label in tick_labels], rotation=45)
@@ -117,25 +101,21 @@ def plot_depth_mapq(depth: np.array,
 
     plt.tight_layout()  # Adjust the layout
 
-    plt.savefig("temp/chromosome.png", dpi=300)
+    plt.savefig(path, dpi=300)
     plt.close()
 
-def plot_mapping_ratio(results_dir: str):
-    # iterate over the file that end with .fasta and count the numbers of lines
+def plot_mapping_ratio(mapping: dict):
+    """
+    Plot the ratio of mapped reads of each chromosome, from the mapping counts of the analyses.
+
+    Args:
+        :param mapping: The mapping counts (s_mapped, s_partially_mapped, s_unmapped) of each chromosome.
+    """
+    names = list(mapping)
     ratio = []
-    names = []
-    for file in os.listdir(results_dir):
-        file_path = os.path.join(results_dir, file)
-        if os.path.isdir(file_path):
-            sizes = []
-            names.append(file)
-            for subfile in os.listdir(file_path):
-                subfile_path = os.path.join(file_path, subfile)
-                with open(subfile_path, "r") as f:
-                    sizes.append(len(f.readlines())//2)  # Divide by 2 to get the number of reads
-
-            # sizes = [only_unmapped, only_mapped, only_partially_mapped]
-            ratio.append((sizes[1] + 0.5*sizes[2]) / sum(sizes))
+    for counts in mapping.values():
+        total = counts["s_mapped"] + counts["s_partially_mapped"] + counts["s_unmapped"]
+        ratio.append((counts["s_mapped"] + 0.5*counts["s_partially_mapped"]) / max(total, 1))
 
     plt.figure(figsize=(10, 5))
     plt.bar(names, ratio)
@@ -162,5 +142,5 @@ def format_size(size: int) -> str:
 
 if __name__ == "__main__":
     os.makedirs(os.path.join(os.getcwd(), "temp"), exist_ok=True)
-    plot_mapping_ratio("mapping_results")
+    plot_mapping_ratio({"Clone1": {"s_mapped": 3, "s_partially_mapped": 2, "s_unmapped": 1}})
     shutil.rmtree(os.path.join(os.getcwd(), "temp"))
\ No newline at end of file
@@ -0,0 +1,215 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Interval between two samples of the resident memory, in seconds
+SAMPLE_INTERVAL = 0.02
+# Returned by stage when the profiling is disabled, so that a disabled stage costs a function call
+DISABLED = nullcontext()
+
+# Profiling of the process: the records of the stages by path ("checkFormat/accumulate/readMapping"),
+# the stages running in each thread and the sampler of the resident memory
+profile = {"enabled": False, "pid": None, "start": None, "stages": {}, "open": [], "sampler": None,
+           "lock": threading.Lock(), "local": threading.local()}
+
+def residentMemory():
+    """
+    Resident memory of the process, in bytes (0 where /proc is missing).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def sampleMemory():
+    """
+    Raise the peak memory of the running stages to the resident memory, until the profiling stops.
+    """
+    while profile["enabled"] and profile["pid"] == os.getpid():
+        memory = residentMemory()
+        with profile["lock"]:
+            for record in profile["open"]:
+                record["peak_rss"] = max(record["peak_rss"], memory)
+        time.sleep(SAMPLE_INTERVAL)
+
+def enableProfiling():
+    """
+    Start the profiling of the process, from empty records (a worker process forked from a profiled process
+    starts again from zero, its records being merged by the parent).
+    """
+    profile.update({"enabled": True, "pid": os.getpid(), "start": time.perf_counter(), "stages": {}, "open": [],
+                    "lock": threading.Lock(), "local": threading.local()})
+    profile["sampler"] = threading.Thread(target=sampleMemory, daemon=True)
+    profile["sampler"].start()
+
+def disableProfiling():
+    profile["enabled"] = False
+
+def stage(name, records=0, nbytes=0):
+    """
+    Time a stage of the pipeline, as a context manager. Nested stages are recorded under the path of their parents.
+
+    Args:
+        name (str): The name of the stage.
+        records (int): The number of records processed by the stage, more can be added with count.
+        nbytes (int): The number of bytes processed by the stage.
+
+    Returns:
+        A context manager, doing nothing when the profiling is disabled.
+    """
+    if not profile["enabled"]: return DISABLED
+    return timedStage(name, records, nbytes)
+
+@contextmanager
+def timedStage(name, records=0, nbytes=0):
+    stack = profile["local"].__dict__.setdefault("stack", [])
+    stack.append(name)
+    with profile["lock"]:
+        record = profile["stages"].setdefault("/".join(stack), {"calls": 0, "seconds": 0.0, "records": 0,
+                                                                 "bytes": 0, "peak_rss": 0})
+        record["calls"] += 1
+        record["records"] += records
+        record["bytes"] += nbytes
+        record["peak_rss"] = max(record["peak_rss"], residentMemory())
+        profile["open"].append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - start
+        with profile["lock"]:
+            record["seconds"] += elapsed
+            record["peak_rss"] = max(record["peak_rss"], residentMemory())
+            profile["open"].remove(record)
+        stack.pop()
+
+def count(records=0, nbytes=0):
+    """
+    Add records and bytes to the innermost running stage of the thread.
+    """
+    if not profile["enabled"]: return
+    stack = profile["local"].__dict__.get("stack")
+    if not stack: return
+    with profile["lock"]:
+        record = profile["stages"]["/".join(stack)]
+        record["records"] += records
+        record["bytes"] += nbytes
+
+def timedIterator(name, iterable, size=None):
+    """
+    Time the production of the items of an iterable (a reader) as a stage, each item being a call.
+
+    Args:
+        name (str): The name of the stage.
+        iterable (iterable): The items.
+        size (callable): Gives the number of records of an item, 1 record per item if None.
+
+    Returns:
+        iterable: The iterable itself when the profiling is disabled.
+    """
+    if not profile["enabled"]: return iterable
+
+    def items():
+        iterator = iter(iterable)
+        while True:
+            with stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                count(1 if size is None else size(item))
+            yield item
+    return items()
+
+def snapshot():
+    """
+    Copy of the records of the stages, to be sent to the parent process.
+    """
+    with profile["lock"]:
+        return {path: dict(record) for path, record in profile["stages"].items()}
+
+def mergeProfile(stages):
+    """
+    Add the records of the stages of a worker process under the running stage of the thread.
+    """
+    if not profile["enabled"] or not stages: return
+    prefix = "/".join(profile["local"].__dict__.get("stack", []))
+    with profile["lock"]:
+        for path, values in stages.items():
+            record = profile["stages"].setdefault(f"{prefix}/{path}" if prefix else path,
+                                                  {"calls": 0, "seconds": 0.0, "records": 0, "bytes": 0,
+                                                   "peak_rss": 0})
+            for key in ("calls", "seconds", "records", "bytes"):
+                record[key] += values[key]
+            record["peak_rss"] = max(record["peak_rss"], values["peak_rss"])
+
+#### Report ####
+def report():
+    """
+    The records of the stages, with their rates and their share of the run.
+
+    Returns:
+        dict: "total" the seconds since the profiling started and "stages" the records by path, in their first order.
+    """
+    total = time.perf_counter() - profile["start"]
+    stages = {}
+    for path, record in snapshot().items():
+        seconds = record["seconds"]
+        stages[path] = {**record, "share": seconds / total if total > 0 else 0,
+                        "records_per_second": record["records"] / seconds if seconds > 0 else 0,
+                        "bytes_per_second": record["bytes"] / seconds if seconds > 0 else 0}
+    return {"total": total, "stages": stages}
+
+def printProfile(file=sys.stderr):
+    """
+    Print the time, the share of the run, the throughput and the peak memory of each stage, nested stages indented.
+    The stages of the worker processes add up the time of every process.
+    """
+    values = report()
+    print(f"\n{'stage':<44}{'calls':>8}{'seconds':>10}{'share':>8}{'records':>12}{'records/s':>13}"
+          f"{'MB/s':>9}{'peak RSS':>10}", file=file)
+    for path, record in values["stages"].items():
+        name = "  " * path.count("/") + path.rsplit("/", 1)[-1]
+        print(f"{name:<44}{record['calls']:>8}{record['seconds']:>10.3f}{record['share']:>8.1%}{record['records']:>12}"
+              f"{record['records_per_second']:>13,.0f}{record['bytes_per_second'] / 1e6:>9.1f}"
+              f"{record['peak_rss'] / (1 << 20):>7.0f} MB", file=file)
+    print(f"{'total':<44}{'':>8}{values['total']:>10.3f}", file=file)
+
+def dumpProfile(path):
+    """
+    Write the records of the stages (see report) in a JSON file.
+    """
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2)
+
+@contextmanager
+def profiledRun(enabled=False, output=None, pstats=None):
+    """
+    Profile a run: the stages are recorded, and the whole run goes through cProfile if pstats is given.
+    At the end the breakdown of the stages is printed, and written in output (JSON) if given.
+    Nothing is done when the profiling is disabled.
+    """
+    if not (enabled or output or pstats):
+        yield
+        return
+
+    enableProfiling()
+    profiler = None
+    if pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(pstats)
+        printProfile()
+        if output: dumpProfile(output)
+        if pstats: print(f"The cProfile statistics are written in {pstats}", file=sys.stderr)
+        disableProfiling()
@@ -0,0 +1,394 @@
+import gzip
+import mmap
+import os
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from common_functions import gatherRagged
+from profiler import stage
+
+# The CIGAR operations in the order of their BAM codes
+BAM_CIGAR_OPERATIONS = "MIDNSHP=X"
+# The bases in the order of their BAM 4-bit codes
+BAM_BASES = np.frombuffer(b"=ACMGRSVTWYHKDBN", dtype=np.uint8)
+# Fixed-size part of a BAM record, starting with its block_size
+BAM_RECORD = np.dtype([("block_size", "<i4"), ("refID", "<i4"), ("pos", "<i4"), ("l_read_name", "u1"),
+                       ("mapq", "u1"), ("bin", "<u2"), ("n_cigar_op", "<u2"), ("flag", "<u2"), ("l_seq", "<i4"),
+                       ("next_refID", "<i4"), ("next_pos", "<i4"), ("tlen", "<i4")])
+
+#### BGZF ####
+def readBgzfBlocks(file):
+    """
+    Yield the compressed data of each block of a BGZF file (a series of gzip members
+    holding the size of their block in a BC extra subfield).
+    """
+    with open(file, "rb") as f:
+        while True:
+            header = f.read(12)
+            if len(header) < 12: return
+            if header[:4] != b"\x1f\x8b\x08\x04":
+                raise ValueError(f"{file} is not a BGZF file")
+            extra = f.read(struct.unpack_from("<H", header, 10)[0])
+
+            # Find the BC subfield giving the size of the whole block minus one
+            block_size, n = None, 0
+            while n < len(extra):
+                length = struct.unpack_from("<H", extra, n + 2)[0]
+                if extra[n:n + 2] == b"BC": block_size = struct.unpack_from("<H", extra, n + 4)[0] + 1
+                n += 4 + length
+            if block_size is None:
+                raise ValueError(f"{file} is not a BGZF file")
+
+            # The compressed data is followed by the CRC32 and the size of the inflated data
+            yield f.read(block_size - 12 - len(extra) - 8)
+            f.read(8)
+
+def inflateBgzf(file, threads=1):
+    """
+    Yield the inflated data of each block of a BGZF file, in order.
+    With more than one thread, the blocks are inflated in parallel (zlib releases the GIL).
+    """
+    if threads == 1:
+        for block in readBgzfBlocks(file):
+            yield zlib.decompress(block, -15)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()  # Bounded number of blocks inflated ahead
+        for block in readBgzfBlocks(file):
+            pending.append(pool.submit(zlib.decompress, block, -15))
+            if len(pending) >= 4 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+#### Memory-mapped SAM ####
+# Columns of a SAM line used by the analyses
+QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, PNEXT, TLEN, SEQ = 0, 1, 2, 3, 4, 5, 7, 8, 9
+POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+def parseIntegers(buffer, starts, ends):
+    """
+    Parse the integers written in a buffer between starts and ends, all at once.
+    Numbers too long to fit in 18 digits are set to the largest int64 so that they fail any range check.
+    """
+    lengths = ends - starts
+    digits, offsets = gatherRagged(buffer, starts, lengths)
+    digits = digits.astype(np.int64) - ord("0")
+
+    # The sign weighs nothing, it only changes the sign of the result
+    negative = np.zeros(len(starts), dtype=bool)
+    negative[lengths > 0] = digits[offsets[:-1][lengths > 0]] == ord("-") - ord("0")
+    digits[offsets[:-1][negative]] = 0
+
+    exponent = np.repeat(lengths - 1 + offsets[:-1], lengths) - np.arange(len(digits))  # Position from the last digit
+    weighted = digits * POWERS_OF_TEN[np.clip(exponent, 0, 18)]
+    values = np.bincount(np.repeat(np.arange(len(starts)), lengths), weights=weighted, minlength=len(starts))
+    values = np.round(values).astype(np.int64)
+    values[lengths > 18] = np.iinfo(np.int64).max
+    return np.where(negative, -values, values)
+
+def scanSam(file, start=0, end=None, with_seq=True, check_block=None, with_location=False, block_bytes=1 << 26):
+    """
+    Read a SAM file mapped in memory. The lines and the columns of a whole block are found at once by looking for
+    the newline and tab bytes with NumPy, and only the columns used by the analyses are decoded.
+
+    Args:
+        file (str): The path of the SAM file.
+        start (int): The byte offset where the reading begins, it has to be the start of a line.
+        end (int): The reading stops at the first line starting at or after this byte offset (end of file if None).
+        with_seq (bool): Whether SEQ is decoded (only needed to write the reads in FASTA files).
+        check_block (callable): If given, called on each block as check_block(buffer, starts, ends, integers, label)
+                                with the start and the end of the mandatory fields of each line, the value of the
+                                integer fields by name and a function giving the label of the line n for the errors.
+        with_location (bool): Whether the byte offset of each line ("offset") and RNAME are added to the batches.
+        block_bytes (int): The approximate amount of data scanned at once.
+
+    Yields:
+        dict: Batches of records (see common_functions.toBatch) holding the QNAME, FLAG, POS, MAPQ, TLEN, CIGAR
+              (empty for "*") and, if with_seq, SEQ columns, plus "offset" and "rname" if with_location.
+    """
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = np.frombuffer(mapped, dtype=np.uint8)
+    size = len(buffer)
+    end = size if end is None else end
+    lines_before = 0
+    window = None
+
+    try:
+        position = start
+        while position < end:
+            # The block ends with a complete line
+            block_end = mapped.find(b"\n", min(position + block_bytes, end) - 1)
+            block_end = min(end, size if block_end == -1 else block_end + 1)
+            window = buffer[position:block_end]
+
+            newlines = np.flatnonzero(window == 10) + position
+            line_starts = np.concatenate(([position], newlines + 1))
+            line_ends = np.concatenate((newlines, [block_end]))
+            if line_starts[-1] == block_end:  # Nothing after the last newline
+                line_starts, line_ends = line_starts[:-1], line_ends[:-1]
+            numbers = lines_before + np.arange(1, len(line_starts) + 1)
+            lines_before += len(line_starts)
+            position = block_end
+
+            # Skip the header and the empty lines, and the carriage returns of Windows files
+            line_ends = line_ends - ((line_ends > line_starts) & (buffer[np.maximum(line_ends - 1, 0)] == 13))
+            records = (line_ends > line_starts) & (buffer[np.minimum(line_starts, size - 1)] != ord("@"))
+            line_starts, line_ends, numbers = line_starts[records], line_ends[records], numbers[records]
+            if len(line_starts) == 0: continue
+
+            # The 10 first tabs of each line separate its 11 mandatory fields
+            tabs = np.flatnonzero(window == 9) + block_end - len(window)
+            tab_index = np.searchsorted(tabs, line_starts)[:, None] + np.arange(11)
+            in_line = tab_index < len(tabs)
+            tab_position = np.where(in_line, tabs[np.minimum(tab_index, len(tabs) - 1)], size)
+            in_line &= tab_position < line_ends[:, None]
+
+            complete = in_line[:, :10].all(axis=1)
+            if not complete.all():
+                n = np.argmin(complete)
+                label = numbers[n] if start == 0 else f"{numbers[n]} after byte {start}"
+                raise ValueError(f"Error line {label} : expected at least 11 columns separated by tabs")
+
+            field_starts = np.column_stack((line_starts, tab_position[:, :10] + 1))
+            field_ends = np.column_stack((tab_position[:, :10], np.where(in_line[:, 10], tab_position[:, 10], line_ends)))
+
+            integers = {name: parseIntegers(buffer, field_starts[:, column], field_ends[:, column])
+                        for name, column in (("FLAG", FLAG), ("POS", POS), ("MAPQ", MAPQ), ("TLEN", TLEN))}
+            if check_block is not None:
+                integers["PNEXT"] = parseIntegers(buffer, field_starts[:, PNEXT], field_ends[:, PNEXT])
+                with stage("check_block", records=len(line_starts)):
+                    check_block(mapped, line_starts, field_ends[:, 10], integers,
+                                lambda n: numbers[n] if start == 0 else f"{numbers[n]} after byte {start}")
+
+            # The CIGAR of the unmapped reads ("*") is stored empty
+            cigar_ends = field_ends[:, CIGAR]
+            cigar_ends = np.where(buffer[field_starts[:, CIGAR]] == ord("*"), field_starts[:, CIGAR], cigar_ends)
+
+            batch = {"size": len(line_starts),
+                     "flag": integers["FLAG"].astype(np.uint16),
+                     "pos": integers["POS"],
+                     "mapq": integers["MAPQ"].astype(np.uint8),
+                     "tlen": integers["TLEN"].astype(np.int32),
+                     "qname": gatherRagged(buffer, field_starts[:, QNAME], field_ends[:, QNAME] - field_starts[:, QNAME]),
+                     "cigar": gatherRagged(buffer, field_starts[:, CIGAR], cigar_ends - field_starts[:, CIGAR])}
+            if with_seq:
+                batch["seq"] = gatherRagged(buffer, field_starts[:, SEQ], field_ends[:, SEQ] - field_starts[:, SEQ])
+            if with_location:
+                batch["offset"] = line_starts
+                batch["rname"] = gatherRagged(buffer, field_starts[:, RNAME], field_ends[:, RNAME] - field_starts[:, RNAME])
+            yield batch
+    finally:
+        del buffer, window  # The mapping cannot be closed while arrays are using it
+        mapped.close()
+
+#### Compressed SAM ####
+def isBgzf(file):
+    """
+    Tell whether a gzip file is made of BGZF blocks (bgzip), which can be inflated independently.
+    """
+    with open(file, "rb") as f:
+        header = f.read(16)
+    return header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+def inflateGzip(file, chunk_size=1 << 22, prefetch=8):
+    """
+    Yield the inflated data of a gzip file by chunks. The file is inflated by a background thread
+    (zlib releases the GIL) while the chunks are consumed, at most prefetch chunks ahead.
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+
+    def inflate():
+        try:
+            with gzip.open(file, "rb") as f:
+                while chunk := f.read(chunk_size):
+                    chunks.put(chunk)
+            chunks.put(None)
+        except Exception as error:  # Raised again on the consumer side
+            chunks.put(error)
+
+    threading.Thread(target=inflate, daemon=True).start()
+    while (chunk := chunks.get()) is not None:
+        if isinstance(chunk, Exception): raise chunk
+        yield chunk
+
+def readCompressedLines(file, threads=1):
+    """
+    Yield the lines (bytes) of a gzip or bgzip compressed text file, decompression overlapping with their use.
+    The BGZF blocks of bgzip files are inflated in parallel, other gzip files are inflated by a background thread.
+    """
+    chunks = inflateBgzf(file, max(threads, 2)) if isBgzf(file) else inflateGzip(file)
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()  # The last line may continue in the next chunk
+        yield from lines
+    if rest: yield rest
+
+#### BAM ####
+def readBam(file, cigar_operations, threads=1, batch_bytes=1 << 24, with_seq=True):
+    """
+    Decode the records of a BAM file without going through the text of a SAM line.
+
+    Args:
+        file (str): The path of the BAM file.
+        cigar_operations (list): The CIGAR operations in the order used by the analyses (SPECS['CIGAR_operations']).
+        threads (int): The number of threads inflating the BGZF blocks.
+        batch_bytes (int): The amount of inflated data decoded at once.
+        with_seq (bool): Whether SEQ and QUAL are decoded (only needed to write the reads in FASTA files).
+
+    Yields:
+        tuple: The header (text, [(reference name, reference length)]) first, then batches of records
+               (see common_functions.toBatch) where the CIGAR is given as an "ops" column of
+               (length << 4 | index in SPECS['CIGAR_operations']) values and RNAME as a "refID" column.
+    """
+    blocks = inflateBgzf(file, threads)
+    data = bytearray()
+
+    def need(size):  # Make sure that at least size bytes are inflated
+        while len(data) < size:
+            block = next(blocks, None)
+            if block is None: return False
+            data.extend(block)
+        return True
+
+    # Header: magic, SAM text and the list of the references
+    if not need(12) or data[:4] != b"BAM\x01":
+        raise ValueError(f"{file} is not a BAM file")
+    l_text = struct.unpack_from("<i", data, 4)[0]
+    need(12 + l_text)
+    text = data[8:8 + l_text].decode().rstrip("\0")
+    n_ref = struct.unpack_from("<i", data, 8 + l_text)[0]
+    position = 12 + l_text
+    references = []
+    for _ in range(n_ref):
+        need(position + 4)
+        l_name = struct.unpack_from("<i", data, position)[0]
+        need(position + 8 + l_name)
+        name = data[position + 4:position + 3 + l_name].decode()
+        references.append((name, struct.unpack_from("<i", data, position + 4 + l_name)[0]))
+        position += 8 + l_name
+    del data[:position]
+    yield text, references
+
+    while need(len(data) + batch_bytes) or data:
+        # Find the start of every complete record
+        starts = []
+        position = 0
+        while position + 4 <= len(data):
+            end = position + 4 + struct.unpack_from("<i", data, position)[0]
+            if end > len(data): break
+            starts.append(position)
+            position = end
+        if not starts:
+            if data: raise ValueError(f"{file} is truncated")
+            return
+
+        yield decodeBamRecords(np.frombuffer(data[:position], dtype=np.uint8), np.array(starts, dtype=np.int64),
+                               cigar_operations, with_seq)
+        del data[:position]
+
+def decodeBamRecords(buffer, starts, cigar_operations, with_seq=True):
+    """
+    Decode BAM records stored in a buffer, all at once.
+
+    Args:
+        buffer (numpy.ndarray): The inflated bytes (uint8) holding the records.
+        starts (numpy.ndarray): The offset of each record in the buffer.
+        cigar_operations (list): The CIGAR operations in the order used by the analyses.
+        with_seq (bool): Whether SEQ and QUAL are decoded.
+
+    Returns:
+        dict: A batch of records (see readBam).
+    """
+    fixed = buffer[starts[:, None] + np.arange(BAM_RECORD.itemsize)].view(BAM_RECORD).ravel()
+    l_read_name = fixed["l_read_name"].astype(np.int64)
+    n_cigar_op = fixed["n_cigar_op"].astype(np.int64)
+    l_seq = fixed["l_seq"].astype(np.int64)
+
+    # The variable-length fields follow each other after the fixed part
+    name_start = starts + BAM_RECORD.itemsize
+    cigar_start = name_start + l_read_name
+    seq_start = cigar_start + 4 * n_cigar_op
+    qual_start = seq_start + (l_seq + 1) // 2
+
+    batch = {"size": len(starts),
+             "flag": fixed["flag"].astype(np.uint16),
+             "pos": fixed["pos"].astype(np.int64) + 1,  # BAM positions are 0-based
+             "mapq": fixed["mapq"].astype(np.uint8),
+             "tlen": fixed["tlen"].astype(np.int32),
+             "refID": fixed["refID"].astype(np.int32),
+             "qname": gatherRagged(buffer, name_start, l_read_name - 1)}  # Without the final NUL
+
+    # CIGAR: length << 4 | BAM code, the code being translated to the order of SPECS['CIGAR_operations']
+    from_bam = np.array([cigar_operations.index(operation) for operation in BAM_CIGAR_OPERATIONS], dtype=np.int64)
+    cigar, cigar_offsets = gatherRagged(buffer, cigar_start, 4 * n_cigar_op)
+    cigar = cigar.view("<u4").astype(np.int64)
+    batch["ops"] = ((cigar >> 4) << 4 | from_bam[cigar & 0xF], cigar_offsets // 4)
+    if not with_seq: return batch
+
+    # SEQ: two bases per byte, the last half byte of odd lengths being padding
+    packed, packed_offsets = gatherRagged(buffer, seq_start, (l_seq + 1) // 2)
+    bases = BAM_BASES[np.stack([packed >> 4, packed & 0xF], axis=1).ravel()]
+    within = np.arange(len(bases)) - np.repeat(2 * packed_offsets[:-1], 2 * (packed_offsets[1:] - packed_offsets[:-1]))
+    seq_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(l_seq, out=seq_offsets[1:])
+    batch["seq"] = (bases[within < np.repeat(l_seq, 2 * (packed_offsets[1:] - packed_offsets[:-1]))], seq_offsets)
+
+    # QUAL: Phred scores without the +33 of the text, 0xFF when missing
+    qual, qual_offsets = gatherRagged(buffer, qual_start, l_seq)
+    batch["qual"] = (np.where(qual == 0xFF, ord("*"), qual + 33).astype(np.uint8), qual_offsets)
+    return batch
+
+#### Header ####
+def readHeader(file):
+    """
+    Read the header of a SAM file, plain or compressed, or of a BAM file without reading its records.
+
+    Returns:
+        str: The lines of the header.
+    """
+    if file.endswith(".bam"):
+        records = readBam(file, [], with_seq=False)
+        text, _ = next(records)
+        records.close()
+        return text
+
+    lines = []
+    with (gzip.open(file, "rb") if file.endswith((".gz", ".bgz")) else open(file, "rb")) as f:
+        for line in f:
+            if not line.startswith(b'@'): break
+            lines.append(line.decode(errors="replace").rstrip('\r\n'))
+    return "\n".join(lines)
+
+def referenceLengths(header):
+    """
+    Length of each reference of a header (@SQ SN and LN), in their order.
+    """
+    references = {}
+    for line in header.splitlines():
+        if line.startswith("@SQ"):
+            tags = dict(field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+            if "SN" in tags and tags.get("LN", "").isdigit(): references[tags["SN"]] = int(tags["LN"])
+    return references
+
+def sortedByName(header):
+    """
+    Tell whether a header declares its records sorted by QNAME (@HD SO:queryname), the records of each chromosome
+    (the prefix of QNAME) then following each other. A file sorted or grouped by reference is not: its chromosomes
+    are not given by RNAME, and its unmapped reads come at the end.
+    """
+    for line in header.splitlines():
+        if line.startswith("@HD"):
+            tags = dict(field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+            return tags.get("SO") == "queryname"
+    return False
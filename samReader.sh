@@ -12,7 +12,8 @@ usage() {
   echo " (__  ) / /_/ /  / / / / / / / _, _/ /  __// /_/ / / /_/ /  /  __/ / /    "
   echo "/____/  \____/  /_/ /_/ /_/ /_/ |_|  \___/ \____/  \____/   \___/ /_/     "
   echo
-  echo "Usage: $0 -i|--input input_file <input.sam> [-o|--output <output_directory>] [-t|--trusted] [-v|--verbose] [-a|--auto-open] [-h|--help]"
+  echo "Usage: $0 -i|--input input_file <input.sam|input.sam.gz|input.bam> [-o|--output <output_directory>] [-t|--trusted] [-v|--verbose] [-a|--auto-open] [-p|--threads <N>] [-r|--region <chr:start-end>] [-f|--format <pdf|json|tsv|npz>] [-P|--profile] [-h|--help]"
+  echo "       $0 -b|--batch <manifest|\"glob\"> [-o|--output <cohort_name>] [-t|--trusted] [-v|--verbose] [-p|--threads <N>] [-r|--region <chr:start-end>] [-f|--format <pdf|json|tsv|npz>] [-P|--profile]"
   # if version is "UNDEFINED PLEASE CONFIGURE IT IN config.yaml"
   if [ "$version" = "UNDEFINED PLEASE CONFIGURE IT IN config.yaml" ]; then
       echo -e "${RED}SAM Version: $version"
@@ -27,6 +28,12 @@ usage() {
   echo "  -t, --trusted             (optional) Skips checking the content of the input file"
   echo "  -v, --verbose             (optional) Shows details of each step"
   echo "  -a, --auto-open           (optional) Open the output file at the end of the analysis"
+  echo "  -p, --threads <N>         (optional) Analyses the input file with N processes (1 by default)"
+  echo "  -r, --region <chr:start-end> (optional) Analyses only the reads of a region, through an index of the input file (.sam)"
+  echo "  -f, --format <pdf|json|tsv|npz> (optional) Writes the PDF report (default) or only the metrics, without LaTeX"
+  echo "  -P, --profile             (optional) Prints the time, the throughput and the peak memory of each stage"
+  echo "  -b, --batch <manifest|\"glob\"> Analyses every file of a manifest (one path per line) or of a glob in one process,"
+  echo "                            and writes the metrics of every sample in <cohort_name>.tsv"
   exit
 }
 
@@ -39,7 +46,7 @@ sam_versions() {
 }
 
 # Using getopt to support both short and long options
-PARSED_OPTIONS=$(getopt -o "hi:o:tva" -l "help,input:,output:,trusted,verbose,ask-to-open" -n "$0" -- "$@")
+PARSED_OPTIONS=$(getopt -o "hi:o:tvap:r:f:Pb:" -l "help,input:,output:,trusted,verbose,ask-to-open,threads:,region:,format:,profile,batch:" -n "$0" -- "$@")
 
 # Open the config.yaml file and get the version
 version=$(grep -oP "[0-9]+\.[0-9]+_[0-9]{4}-[0-9]{2}-[0-9]{2}" "$(dirname "$0")"/config.yaml)
@@ -72,6 +79,11 @@ output_file=""
 trusted=
 verbose=
 auto_open=
+threads=
+region=
+output_format=
+profile=
+batch=
 
 # Parsing options
 while true; do
@@ -88,6 +100,16 @@ while true; do
             verbose=true; shift;;
         -a|--ask-to-open)
             auto_open=true; shift;;
+        -p|--threads)
+            threads=$2; shift 2;;
+        -r|--region)
+            region=$2; shift 2;;
+        -f|--format)
+            output_format=$2; shift 2;;
+        -P|--profile)
+            profile=true; shift;;
+        -b|--batch)
+            batch=$2; shift 2;;
         --)
             shift; break;;
         *)
@@ -95,6 +117,12 @@ while true; do
     esac
 done
 
+# In batch mode, each input file is checked by main.py, a faulty one being left out of the cohort
+if [ ! -z "$batch" ]; then
+    python3 "$(dirname "$0")"/main.py -b "$batch" -o "$output_file" ${trusted:+-t} ${verbose:+-v} ${threads:+-p "$threads"} ${region:+-r "$region"} ${output_format:+-f "$output_format"} ${profile:+-P}
+    exit $?
+fi
+
 # This script reads the sam file and check if the file is empty or not, containing unauthorized characters or not and then
 # starts main.py script to read the sam file and generate the output file.
 
@@ -128,18 +156,23 @@ if [ ! -s "$input_file" ]; then
     usage;
 fi
 
-# if the file is trusted, we don't check the content
-if [ ! -z "$trusted" ]; then
-    python3 "$(dirname "$0")"/main.py -i "$input_file" -o "$output_file" ${trusted:+-t} ${verbose:+-v} ${auto_open:+-a}
+# if the file is trusted or binary (BAM), we don't check the content
+if [ ! -z "$trusted" ] || [[ "$input_file" == *.bam ]]; then
+    python3 "$(dirname "$0")"/main.py -i "$input_file" -o "$output_file" ${trusted:+-t} ${verbose:+-v} ${auto_open:+-a} ${threads:+-p "$threads"} ${region:+-r "$region"} ${output_format:+-f "$output_format"} ${profile:+-P}
     exit 0
 fi
 
 # Check if the sam file is not containing unauthorized characters
 query=$(grep 'GLOBAL: ' "$(dirname "$0")/SAM_specs/$version/specs.yaml" | cut -d ' ' -f 2)
-if ! grep -q "$query" "$input_file"; then
+if [[ "$input_file" == *.gz || "$input_file" == *.bgz ]]; then
+    reader="gzip -cd"  # The compressed file is streamed, grep stops at the first match
+else
+    reader="cat"
+fi
+if ! $reader "$input_file" | grep -q "$query"; then
     echo "The input file is containing unauthorized characters. Please provide a file in the right format ($query)."
     usage;
 fi
 
 # parse the parameters and start the main.py script
-python3 "$(dirname "$0")"/main.py -i "$input_file" -o "$output_file" ${trusted:+-t} ${verbose:+-v} ${auto_open:+-a}
+python3 "$(dirname "$0")"/main.py -i "$input_file" -o "$output_file" ${trusted:+-t} ${verbose:+-v} ${auto_open:+-a} ${threads:+-p "$threads"} ${region:+-r "$region"} ${output_format:+-f "$output_format"} ${profile:+-P}